@@ -1,12 +1,41 @@
 import streamlit as st
 import streamlit.components.v1 as components
-import requests
+import functools
 import os
 import json
 import re
-import re as _re
+import shutil
+import threading
+import time
+
+import canon
+import cassette
+import export
+import history
+import profiler
+import session_memory
+import storage
+from engine import (
+    base_for,
+    build_payload,
+    directive_exact_reply,
+    is_placeholder,
+    length_profile,
+    run_turn,
+    sampling_for,
+    user_turn,
+)
+from jobs import JobManager
+from length_stats import LengthStats
+from openrouter import DEFAULT_URL, ModelRouter, UpstreamError, preconnect
+from scheduler import BACKGROUND, INTERACTIVE, RequestScheduler
 
 st.set_page_config(page_title="GPT Chatbot (DeepSeek)", page_icon="🤖")
+
+# ⏱️ "Profile this rerun": the profiler starts here and is read at the Debug panel. If the
+# run ends early with st.rerun(), it keeps going through the follow-up run until one gets there.
+if st.session_state.pop("_profile_next", False) and st.session_state.get("_profiler") is None:
+    st.session_state._profiler = profiler.start()
 st.markdown("""
 <style>
 *, ::before, ::after { overflow-anchor: none !important; }
@@ -23,116 +52,30 @@ def pin_to_canon_safe(text: str):
     # take the last 1–2 sentences, or trim to 280 chars if it's short
     parts = re.split(r'(?<=[.!?])\s+', snippet)
     short = " ".join(parts[-2:]) if len(parts) > 1 else snippet[:280]
-    st.session_state.canon.append(short)
-    
-# --- Scroll restore / target scroll ---
-target = st.session_state.pop("_scroll_target", None)
-
-components.html(
-    f"""
-    <script>
-      const targetId = {json.dumps(target)};
-      const savedY = sessionStorage.getItem("scroll-y");
-
-      function jump() {{
-        if (targetId) {{
-          const el = document.getElementById(targetId);
-          if (el) {{
-            el.scrollIntoView({{ behavior: "instant", block: "center" }});
-            return true;
-          }}
-        }}
-        if (!targetId && savedY !== null) {{
-          window.scrollTo(0, parseFloat(savedY));
-          return true;
-        }}
-        return false;
-      }}
-
-      let tries = 10;
-      const tryJump = () => {{
-        if (jump() || --tries <= 0) clearInterval(timer);
-      }};
-      tryJump();
-      const timer = setInterval(tryJump, 120);
-
-      window.addEventListener("scroll", () => {{
-        sessionStorage.setItem("scroll-y", String(window.scrollY));
-      }});
-    </script>
-    """,
-    height=0,
+    # near-duplicates are dropped and overlapping notes merged, so heavy pinning stays small
+    st.session_state.canon, outcome = canon.add_entry(st.session_state.canon, short)
+    return outcome
+    
+# --- Scroll anchoring ---
+# One declared component owns scrolling (bottom-anchor, msg-{i}, edit-{i}). It is called at
+# the same spot near the top of every run, so the iframe is mounted once and only receives new
+# args. It sends the target queued before that spot (a reply that just finished) or by the
+# previous run (button handlers set `_scroll_target` and st.rerun()).
+_scroll_anchor = components.declare_component(
+    "scroll_anchor", path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "components", "scroll_anchor")
 )
 
+def mount_scroll_anchor():
+    """Send a new jump for `_scroll_target` (if any); keep re-sending it until the browser says it landed."""
+    target = st.session_state.pop("_scroll_target", None)
+    if target:
+        # wall-clock nonce: stays increasing across sessions sharing the browser tab's storage
+        st.session_state._scroll_cmd = {"target": target, "nonce": int(time.time() * 1000)}
+    cmd = st.session_state.get("_scroll_cmd") or {}
+    landed = _scroll_anchor(target=cmd.get("target"), nonce=cmd.get("nonce"), key="scroll_anchor", default=None)
+    if cmd and landed == cmd["nonce"]:
+        st.session_state._scroll_cmd = None
 
-# --- Bracket enforcement helpers ---
-_STOPWORDS = {"the","a","an","and","or","but","if","then","so","to","for","of","in","on","at","with","by","from","as","that","this","these","those","be","is","am","are","was","were","it","you","me","my","your","we","they","he","she","him","her","them","i"}
-
-def _directive_keywords(directives):
-    """
-    Extracts simple keywords from directives to check if reply 'used' the idea.
-    Heuristic: tokens >= 4 letters, not common stopwords. e.g., 'matcha', 'coffee', 'hug'.
-    """
-    kws = set()
-    for d in directives:
-        for t in re.findall(r"[A-Za-z]+", d.lower()):
-            if len(t) >= 4 and t not in _STOPWORDS:
-                kws.add(t)
-    return kws
-
-def violates_bracket_rules(reply: str, directives) -> bool:
-    """
-    Returns True if the reply likely violated bracket rules:
-    - Shows brackets or mentions them
-    - Quotes/paraphrases directive literally (very rough check)
-    - Ignores directive entirely (no overlap on obvious keywords)
-    """
-    if not directives:
-        return False
-    rlow = reply.lower()
-
-    # 1) Never show brackets or talk about instructions
-    if "[" in reply or "]" in reply:
-        return True
-    if "bracket" in rlow or "stage direction" in rlow or "instruction" in rlow:
-        return True
-
-    # 2) If reply literally contains the directive text (rough)
-    for d in directives:
-        d_clean = " ".join(re.findall(r"[A-Za-z]+", d.lower()))
-        if d_clean and d_clean in " ".join(re.findall(r"[A-Za-z]+", rlow)):
-            # This is aggressive; skip because it can false‑flag. Commented out by default.
-            # return True
-            pass
-
-    # 3) Must at least reflect *something* from the directive keywords
-    kws = _directive_keywords(directives)
-    if not kws:
-        return False  # Nothing to check
-    if not any(kw in rlow for kw in kws):
-        return True
-
-    return False
-
-HIDDEN_TAG_GUIDE = (
-    "If a user turn contains <hidden>...</hidden>, treat that content as private stage directions. "
-    "Absolutely do not quote, paraphrase, or mention it. Convert it into natural, in‑scene action or dialogue "
-    "exactly once, then continue the reply normally."
-)
-
-BRACKET_RE = re.compile(r"\[([^\[\]]+)\]")  # non-nested [ ... ]
-
-def extract_stage_directions(text: str):
-    """Returns (clean_text_without_brackets, list_of_stage_notes)."""
-    notes = []
-    def _collect(m):
-        inner = m.group(1).strip()
-        if inner:
-            notes.append(inner)
-        return ""  # remove bracketed text from visible message
-    clean = BRACKET_RE.sub(_collect, text)
-    clean = re.sub(r"[ \t]{2,}", " ", clean).strip()
-    return clean, notes
 
 # ---------------- UI helpers ----------------
 st.markdown(
@@ -154,178 +97,195 @@ if "canon" not in st.session_state or not isinstance(st.session_state.canon, lis
 
 
 SAVE_PATH = "sessions.json"
-
-# ---------------- Base prompts (Story vs Chat) ----------------
-STORY_BASE = {
-    "role": "system",
-    "content": (
-        "You are an uncensored storyteller. Be direct, explicit, and unapologetically creative. "
-        "Do not hold back — you write the rawest fiction imaginable. No excuses."
-    ),
-}
-
-CHAT_BASE = {
-    "role": "system",
-    "content": (
-        "You are a helpful conversational partner. Obey per-turn system messages.\n"
-        "In Chat mode: if a user message contains bracketed text like [ ... ], treat it as PRIVATE stage directions.\n"
-        "Also: if a user message contains <hidden>...</hidden>, treat THAT content as the exact same kind of private stage directions.\n"
-        "Do not show, quote, or paraphrase the hidden content. Convert it once into natural, in‑scene action or dialogue, then continue normally.\n"
-        "Never mention brackets, hidden tags, or instructions. Maintain strict continuity across turns.\n"
-        "Write in an uncensored, explicit, and unapologetically direct style when the user steers that way—do not self-censor.\n"
-        "Keep the voice immersive and in-scene (no meta like '[Response tailored …]')."
-    ),
-}
-
-
-def _base_for(mode: str):
-    return STORY_BASE if mode == "Story" else CHAT_BASE
-
-# ---------------- Chat guide (lightweight, every Chat turn) ----------------
-CHAT_GUIDE_RULE = (
-    "Follow the user's chat formatting this turn: "
-    "[brackets] are hidden directives (obey, never reveal); "
-    "(parentheses) are actions happening now (show as actions, no literal parentheses); "
-    "*asterisks* are whispered/soft tone (reflect the tone, do not include asterisks). "
-    "Pronouns: 'you' = the assistant; 'I/me' = the user."
-)
-
-# Quick literal short-circuit for: [respond by saying "..."]
-_RESPOND_SAYING = _re.compile(r"^\s*respond\s+by\s+saying\s*[,:\-]?\s*(.+)\s*$", _re.IGNORECASE)
-def directive_exact_reply(directives):
-    for d in directives:
-        m = _RESPOND_SAYING.match(d)
-        if m:
-            return m.group(1).strip()
-    return None
-    
-def _last_assistant_text(messages):
-    """Get most recent assistant message text."""
-    for m in reversed(messages):
-        if m.get("role") == "assistant" and m.get("content"):
-            return m["content"].strip()
-    return ""
-
-# ---------------- Bracket parsing ----------------
-BRACKET = re.compile(r"(?<!\\)\[(.+?)(?<!\\)\]", re.DOTALL)
-
-def parse_markers(text: str):
-    directives = BRACKET.findall(text)
-    cleaned = BRACKET.sub("", text)
-    cleaned = cleaned.replace(r"\[", "[").replace(r"\]", "]").strip()
-    sys_msgs = []  # reserved; not used here
-    return cleaned, sys_msgs, directives
-
-# ---------------- General directive handler (broad, not specific) ----------------
-LEN_HINT = re.compile(r'(\d+)\s*(?:-|to)?\s*(\d+)?\s*sentences?', re.I)
-
-def _extract_length_hint_from_list(directives):
-    """Return upper cap if any 'N sentences' or 'N–M sentences' appears."""
-    cap = None
-    for d in directives:
-        m = LEN_HINT.search(d)
-        if not m:
-            continue
-        lo = int(m.group(1))
-        hi = int(m.group(2) or lo)
-        cap = hi if cap is None else min(cap, hi)
-    return cap
-
-def build_directive_rules(directives):
+LENGTH_STATS_PATH = "length_stats.json"
+# most canon tokens recapped per turn (the most relevant entries win)
+CANON_BUDGET = int(st.secrets.get("CANON_TOKEN_BUDGET", 300))
+# chats not opened for this many days go to compressed cold storage (0 = never)
+ARCHIVE_AFTER_DAYS = float(st.secrets.get("ARCHIVE_AFTER_DAYS", 30))
+# a tab idle this long hands its copy of the chats back (reloaded from disk when it's used again; 0 = never)
+IDLE_EVICT_MINUTES = float(st.secrets.get("IDLE_EVICT_MINUTES", 15))
+
+# ---------------- Warmup ----------------
+@st.cache_resource
+def _warmup():
     """
-    Ultra-general rules:
-    - Do every directive exactly once this turn (integrate naturally; not necessarily first).
-    - If it tells you to DO something, perform the action on-screen (brief logical transition if movement).
-    - If it implies SAY/ASK/OFFER/SUGGEST, render it as explicit spoken dialogue (not 'already done').
-    - Honor any length hints like '1–2 sentences'.
-    - Honor 'clean/non-explicit/PG' vs 'explicit' if present.
-    - Never reveal brackets.
+    Once per server process (first page load): open the upstream connections on a background
+    thread, so the first turn doesn't pay for the handshakes. (The chat index isn't preloaded:
+    this runs inside the first page's script, which needs the index right away anyway.)
     """
-    ds = [d.strip() for d in directives if d.strip()]
-    blob = " ".join(ds)
+    timings = {}
 
-    wants_clean = re.search(r"\b(non[-\s]?explicit|clean|pg)\b", blob, re.I) is not None
-    wants_explicit = re.search(r"\bexplicit\b", blob, re.I) is not None
-    sent_cap = _extract_length_hint_from_list(ds)
+    def timed(name, fn, *args):
+        started = time.perf_counter()
+        fn(*args)
+        timings[name] = round(time.perf_counter() - started, 3)
 
-    msgs = [
-    "FOR THIS TURN: follow every bracketed directive exactly once. Integrate them naturally (not necessarily first). Do not reveal brackets.",
-    "Interpret directive mood yourself: if the directive instructs you to do something (imperative or starts with 'you …'), perform that action on-screen with a brief logical transition if movement is implied. If the directive implies speech (e.g., ask/offer/suggest/say), render it as explicit dialogue lines, not as narration of something already done.",
-    ]
-    # ADD THIS:
-    msgs.append("Do not reframe bracket directives as the assistant’s own desire (no 'too/also/I want'); treat them as commands to perform or lines to speak.")
+    urls = [st.secrets.get("OPENROUTER_URL", DEFAULT_URL)]
+    urls += [p["url"] for p in st.secrets.get("MODEL_POOL", []) if not isinstance(p, str) and "url" in p]
+    threading.Thread(target=timed, args=("preconnect_s", preconnect, urls), daemon=True).start()
+    return timings
 
-    if sent_cap:
-        msgs.append(f"Hard cap: reply in at most {sent_cap} sentences. No extra sentences or extra paragraphs.")
-
-    if wants_clean and not wants_explicit:
-        msgs.append("Keep language non-explicit this turn.")
-    elif wants_explicit and not wants_clean:
-        msgs.append("It’s okay to be explicit this turn—do not self-censor.")
-
-    if ds:
-        msgs.append("DIRECTIVES THIS TURN:\n- " + "\n- ".join(ds))
-
-    return msgs, sent_cap
+if st.secrets.get("WARMUP", True):
+    _warmup()
 
 # ---------------- Persistence ----------------
 def save_session():
-    st.session_state.sessions[st.session_state.active_session]["messages"] = st.session_state.messages.copy()
+    # only the active branch's delta is written back; shared prefixes live in the parents
+    history.commit(st.session_state.sessions[st.session_state.active_session]["tree"], st.session_state.messages)
     # also persist persona + canon for the active chat
     st.session_state.sessions[st.session_state.active_session]["persona"] = dict(st.session_state.get("persona", {}))
     st.session_state.sessions[st.session_state.active_session]["canon"] = list(st.session_state.get("canon", []))
-    with open(SAVE_PATH, "w") as f:
-        json.dump(st.session_state.sessions, f)
+    st.session_state.sessions[st.session_state.active_session]["last_opened"] = time.time()
+    storage.save_sessions(SAVE_PATH, st.session_state.sessions)
+
+def open_chat(name):
+    """Make `name` the active chat and load its working copies (unpacking it if archived); False if it can't be restored."""
+    try:
+        rec = storage.rehydrate(SAVE_PATH, st.session_state.sessions, name)
+    except FileNotFoundError:
+        st.error(f"⚠️ Couldn't open “{name}”: its archived copy is missing.")
+        return False
+    st.session_state.active_session = name
+    st.session_state.messages = history.materialize(rec["tree"])
+    st.session_state.persona = dict(rec.get("persona", {}))
+    st.session_state.canon = list(rec.get("canon", []))
+    return True
+
+def open_first_chat(names):
+    """Open the first of `names` that can be restored, or a fresh chat if none can."""
+    for name in names:
+        if open_chat(name):
+            return
+    n = len(st.session_state.sessions) + 1
+    while f"Chat {n}" in st.session_state.sessions:
+        n += 1
+    st.session_state.sessions[f"Chat {n}"] = storage.new_record(base_for(st.session_state.get("mode", "Chat")))
+    open_chat(f"Chat {n}")
+
+def fork_active_chat(at):
+    """Park the current continuation on its own branch and start a new one sharing messages[:at]."""
+    tree = st.session_state.sessions[st.session_state.active_session]["tree"]
+    history.commit(tree, st.session_state.messages)
+    history.fork(tree, at)
+
+@st.cache_resource
+def _jobs():
+    """Process-wide generation jobs, keyed by chat id, so they survive reruns, chat switches and reconnects."""
+    return JobManager(
+        max_workers=8,
+        # a prefetched reply is only saved once the user adopts it (its kind flips to "turn")
+        on_done=lambda job: job.kind == "turn" and storage.append_message(SAVE_PATH, job.chat_id, job.branch, job.result),
+    )
+
+@st.cache_resource
+def _recorder():
+    """Cassette recorder for upstream calls + UI actions, if RECORD_CASSETTE is set (see cassette.py)."""
+    path = st.secrets.get("RECORD_CASSETTE")
+    return cassette.install(path) if path else None
+
+def record_action(action, **data):
+    rec = _recorder()
+    if rec is not None:
+        rec.action(action, chat=st.session_state.active_session, **data)
+
+def apply_finished_jobs():
+    """Fold replies that background jobs finished (and already saved) into this session's copy of the chats."""
+    applied = st.session_state.setdefault("_applied_jobs", set())
+    by_id = {rec["id"]: name for name, rec in st.session_state.sessions.items()}
+    changed = False
+    for job in _jobs().for_chats(by_id):
+        if job.status != "done" or job.id in applied:
+            continue
+        applied.add(job.id)
+        name = by_id[job.chat_id]
+        if storage.is_archived(st.session_state.sessions[name]):
+            continue  # the job wrote it into the archive; it's there when the chat is opened
+        tree = st.session_state.sessions[name]["tree"]
+        if job.branch not in tree["branches"]:
+            continue
+        if name == st.session_state.active_session and tree["head"] == job.branch:
+            msgs = st.session_state.messages
+        else:
+            msgs = tree["branches"][job.branch]["delta"]
+        if any(m.get("job") == job.id for m in msgs):
+            continue  # loaded from disk after the job saved it
+        msgs.append(job.result)
+        changed = True
+    if changed:
+        save_session()
+        st.session_state._scroll_target = "bottom-anchor"
+
+# ---------------- Idle-session memory ----------------
+def _state_get(state, key):
+    return state[key] if key in state else None
+
+@st.cache_resource
+def _session_memory():
+    """Process-wide registry of browser sessions; its janitor evicts idle ones (see session_memory.py)."""
+    jobs = _jobs()
+
+    def can_evict(state):
+        # only sessions with nothing unsaved: no reply being written, no edit or send in flight
+        if not _state_get(state, "sessions_initialized") or "sessions" not in state:
+            return False
+        if _state_get(state, "pending_input") is not None or _state_get(state, "edit_index") is not None:
+            return False
+        ids = [r["id"] for r in state["sessions"].values()]
+        return not jobs.active(ids) and not jobs.active(ids, kind="prefetch")
+
+    return session_memory.SessionRegistry(
+        idle_after=IDLE_EVICT_MINUTES * 60,
+        interval=60 if IDLE_EVICT_MINUTES > 0 else 0,
+        can_evict=can_evict,
+    )
+
+def restore_evicted_state():
+    """Reload the chats an idle session gave up; the active chat is taken from disk as last saved."""
+    st.session_state.pop("_evicted_at", None)
+    st.session_state.sessions = storage.load_sessions(SAVE_PATH, base_for(st.session_state.get("mode", "Chat")))
+    # the active chat may have been renamed or deleted from another tab meanwhile
+    names = list(st.session_state.sessions)
+    if st.session_state.active_session in names:
+        names.remove(st.session_state.active_session)
+        names.insert(0, st.session_state.active_session)
+    open_first_chat(names)
+
+_session_memory().touch(*session_memory.current())
+if "_evicted_at" in st.session_state:
+    restore_evicted_state()
 
 # ---------------- First load ----------------
 if not st.session_state.get("sessions_initialized"):
-    def _default_chat_record(base_msg):
-        return {
-            "messages": [base_msg],
-            "persona": {"who": "", "role": "", "themes": "", "boundaries": ""},
-            "canon": [],
-        }
-
-    base_for_mode = _base_for(st.session_state.get("mode", "Chat"))
-
-    if os.path.exists(SAVE_PATH):
-        with open(SAVE_PATH, "r") as f:
-            st.session_state.sessions = json.load(f)
-        # MIGRATION: if any chat value is a list, wrap it into the new dict format
-        migrated = {}
-        for name, val in st.session_state.sessions.items():
-            if isinstance(val, list):
-                migrated[name] = {
-                    "messages": val,
-                    "persona": {"who": "", "role": "", "themes": "", "boundaries": ""},
-                    "canon": [],
-                }
-            else:
-                # ensure keys exist
-                migrated[name] = {
-                    "messages": val.get("messages", [base_for_mode]),
-                    "persona": val.get("persona", {"who": "", "role": "", "themes": "", "boundaries": ""}),
-                    "canon": val.get("canon", []),
-                }
-        st.session_state.sessions = migrated
+    base_for_mode = base_for(st.session_state.get("mode", "Chat"))
+
+    # storage.load_sessions also migrates older record formats
+    st.session_state.sessions = storage.load_sessions(SAVE_PATH, base_for_mode)
+    if st.session_state.sessions:
         st.session_state.active_session = list(st.session_state.sessions.keys())[0]
+        if ARCHIVE_AFTER_DAYS > 0:
+            storage.archive_stale(SAVE_PATH, st.session_state.sessions, ARCHIVE_AFTER_DAYS * 86400,
+                                  keep={st.session_state.active_session})
     else:
-        st.session_state.sessions = {"Chat 1": _default_chat_record(_base_for("Chat"))}
+        st.session_state.sessions = {"Chat 1": storage.new_record(base_for("Chat"))}
         st.session_state.active_session = "Chat 1"
 
     # hydrate working copies for active chat
-    rec = st.session_state.sessions[st.session_state.active_session]
-    st.session_state.messages = rec["messages"].copy()
-    st.session_state.persona = dict(rec.get("persona", {}))
-    st.session_state.canon = list(rec.get("canon", []))
+    open_first_chat(list(st.session_state.sessions))
 
     st.session_state.sessions_initialized = True
 
+# Replies finished in the background since the last run
+apply_finished_jobs()
+mount_scroll_anchor()
+
 # ---------------- Sidebar ----------------
 st.sidebar.header("Chats")
 
 # 🐛 Debug toggle (put right under the header)
 DEBUG = st.sidebar.toggle("🐛 Debug", value=False, help="Show last error and payload tail")
+if DEBUG and st.sidebar.button("⏱️ Profile this rerun", help="Run the page once more under cProfile; the results show in the Debug panel."):
+    st.session_state._profile_next = True
+    st.rerun()
 
 if "sessions" not in st.session_state:
     st.session_state.sessions = {}
@@ -333,23 +293,31 @@ if "active_session" not in st.session_state:
     st.session_state.active_session = "Session 1"
 
 mode = st.sidebar.radio("Mode", ["Story", "Chat"], key="mode")
+n_candidates = st.sidebar.slider(
+    "Candidates per reply", 1, 4, 1, key="n_candidates",
+    help="Sample several replies in one go and pick the one you like.",
+)
+st.sidebar.toggle(
+    "⚡ Prefetch next Continue", value=False, key="prefetch_continue",
+    help="Story mode: write the next 'continue' in the background so it's ready the moment you ask.",
+)
 session_names = list(st.session_state.sessions.keys())
 
+def _chat_label(name):
+    rec = st.session_state.sessions.get(name)
+    return f"🗄️ {name}" if storage.is_archived(rec) else name
+
 if session_names:
     try:
         selected = st.sidebar.selectbox(
             "Active Chat",
             session_names,
             index=session_names.index(st.session_state.active_session),
+            format_func=_chat_label,
         )
     except ValueError:
-        selected = st.sidebar.selectbox("Active Chat", session_names, index=0)
-        st.session_state.active_session = session_names[0]
-    
-        rec = st.session_state.sessions[session_names[0]]
-        st.session_state.messages = rec["messages"].copy()
-        st.session_state.persona  = dict(rec.get("persona", {}))
-        st.session_state.canon    = list(rec.get("canon", []))
+        selected = st.sidebar.selectbox("Active Chat", session_names, index=0, format_func=_chat_label)
+        open_first_chat(session_names)
     
         st.session_state.edit_index = None
         st.rerun()
@@ -361,14 +329,10 @@ if session_names and selected != st.session_state.active_session:
     # ✅ Save the current chat before switching
     save_session()
 
-    # Now switch
-    st.session_state.active_session = selected
-    rec = st.session_state.sessions[selected]
-    st.session_state.messages = rec["messages"].copy()
-    st.session_state.persona = dict(rec.get("persona", {}))
-    st.session_state.canon = list(rec.get("canon", []))
-    st.session_state.edit_index = None
-    st.rerun()
+    # Now switch (unpacks archived chats; on failure we stay on the current one)
+    if open_chat(selected):
+        st.session_state.edit_index = None
+        st.rerun()
 
 if st.sidebar.button("+ New Chat"):
     # ✅ Save the current chat first so nothing gets overwritten
@@ -381,18 +345,14 @@ if st.sidebar.button("+ New Chat"):
         n += 1
         new_name = f"Chat {n}"
 
-    base = _base_for(st.session_state.get("mode", "Chat"))
+    base = base_for(st.session_state.get("mode", "Chat"))
 
-    st.session_state.sessions[new_name] = {
-        "messages": [base],  # fresh history
-        "persona": {"who": "", "role": "", "themes": "", "boundaries": ""},
-        "canon": [],
-    }
+    st.session_state.sessions[new_name] = storage.new_record(base)  # fresh history
 
     # Switch to the new chat and hydrate clean working copies
     st.session_state.active_session = new_name
     rec = st.session_state.sessions[new_name]
-    st.session_state.messages = rec["messages"].copy()
+    st.session_state.messages = history.materialize(rec["tree"])
     st.session_state.persona = dict(rec["persona"])
     st.session_state.canon = list(rec["canon"])
     st.session_state.edit_index = None
@@ -421,22 +381,10 @@ with st.sidebar.expander("🗑️ Manage Chats"):
         st.session_state.sessions.pop(deleted, None)
     
         if st.session_state.sessions:
-            new_active = list(st.session_state.sessions.keys())[0]
-            st.session_state.active_session = new_active
-    
-            rec = st.session_state.sessions[new_active]
-            st.session_state.messages = rec["messages"].copy()
-            st.session_state.persona  = dict(rec.get("persona", {}))
-            st.session_state.canon    = list(rec.get("canon", []))
+            open_first_chat(list(st.session_state.sessions))
         else:
-            base = _base_for(st.session_state.get("mode", "Chat"))
-            st.session_state.sessions = {
-                "Chat 1": {
-                    "messages": [base],
-                    "persona": {"who": "", "role": "", "themes": "", "boundaries": ""},
-                    "canon": [],
-                }
-            }
+            base = base_for(st.session_state.get("mode", "Chat"))
+            st.session_state.sessions = {"Chat 1": storage.new_record(base)}
             st.session_state.active_session = "Chat 1"
             st.session_state.messages = [base]
             st.session_state.persona  = {"who": "", "role": "", "themes": "", "boundaries": ""}
@@ -447,23 +395,53 @@ with st.sidebar.expander("🗑️ Manage Chats"):
 
 
     if st.button("⚠️ Delete ALL conversations"):
-        base = _base_for(st.session_state.get("mode", "Chat"))
-        st.session_state.sessions = {
-            "Chat 1": {
-                "messages": [base],
-                "persona": {"who": "", "role": "", "themes": "", "boundaries": ""},
-                "canon": [],
-            }
-        }
+        base = base_for(st.session_state.get("mode", "Chat"))
+        st.session_state.sessions = {"Chat 1": storage.new_record(base)}
         st.session_state.active_session = "Chat 1"
         st.session_state.messages = [base]
         st.session_state.persona = {"who": "", "role": "", "themes": "", "boundaries": ""}
         st.session_state.canon = []
         if os.path.exists(SAVE_PATH):
             os.remove(SAVE_PATH)
+        shutil.rmtree(storage.archive_dir(SAVE_PATH), ignore_errors=True)
         save_session()
         st.rerun()
 
+with st.sidebar.expander("📤 Export Chat"):
+    export_fmt = st.radio("Format", list(export.FORMATS), horizontal=True, key="export_format")
+    export_user = st.checkbox("Include my turns", value=True, key="export_user")
+    _export_rec = st.session_state.sessions[st.session_state.active_session]
+    ext, mime = export.FORMATS[export_fmt]
+    file_stem = re.sub(r"[^\w\- ]+", "", st.session_state.active_session).strip() or "chat"
+    # nothing is built on reruns: on click the saved tree is streamed into a temp file
+    st.download_button(
+        "⬇️ Download",
+        data=functools.partial(export.export_file, _export_rec["tree"], export_fmt, st.session_state.active_session,
+                               include_user=export_user, uid=_export_rec["id"]),
+        file_name=f"{file_stem}.{ext}",
+        mime=mime,
+        on_click="ignore",
+    )
+
+_tree = st.session_state.sessions[st.session_state.active_session]["tree"]
+if len(_tree["branches"]) > 1:
+    with st.sidebar.expander("🌿 Branches"):
+        bids = list(_tree["branches"].keys())
+        labels = {b: history.branch_label(_tree, b) for b in bids}
+        picked = st.selectbox(
+            "Active branch",
+            bids,
+            index=bids.index(_tree["head"]),
+            format_func=labels.get,
+            key=f"branch_pick_{hash(tuple(labels.values()))}",  # fresh widget whenever the labels change
+        )
+        if picked != _tree["head"]:
+            save_session()
+            _tree["head"] = picked
+            st.session_state.messages = history.materialize(_tree)
+            st.session_state.edit_index = None
+            save_session()
+            st.rerun()
 
 with st.sidebar.expander("📘 Chat Input Guide"):
     st.markdown("""
@@ -532,13 +510,17 @@ if st.session_state.get("mode") == "Chat":
             "Pinned facts / continuity notes",
             value=canon_text,
             height=150,
-            help="Short bullets. Keep it tight; this is injected each turn."
+            help=f"Short bullets. The ones most relevant to each turn are recapped, up to ~{CANON_BUDGET} tokens."
         )
+        if st.session_state.canon:
+            tok = [canon.estimate_tokens(c) for c in st.session_state.canon]
+            st.caption(f"~{sum(tok)} tokens in {len(tok)} notes · budget ~{CANON_BUDGET} per turn")
+            st.markdown("\n".join(f"- `{t}` {c[:60]}{'…' if len(c) > 60 else ''}" for t, c in zip(tok, st.session_state.canon)))
         colA, colB = st.columns(2)
         with colA:
             if st.button("Save Canon"):
                 lines = [line.strip() for line in (new_canon or "").splitlines() if line.strip()]
-                st.session_state.canon = lines
+                st.session_state.canon = canon.consolidate(lines)
                 save_session()
                 st.rerun()
                 
@@ -552,11 +534,152 @@ if st.session_state.get("mode") == "Chat":
 api_key = st.secrets["OPENROUTER_API_KEY"]
 referer_url = st.secrets["REFERER_URL"]
 model = "thedrummer/skyfall-36b-v2"
+# Ordered fallback pool; entries are model names or {model, url} tables (e.g. local stubs)
+MODEL_POOL = [p if isinstance(p, str) else dict(p) for p in st.secrets.get("MODEL_POOL", [model])]
+
+@st.cache_resource
+def _router():
+    """Process-wide model router, so latency/error stats are shared by all sessions."""
+    _recorder()  # install the cassette recorder (if enabled) before the first call
+    hedge_after = st.secrets.get("ROUTER_HEDGE_AFTER")
+    return ModelRouter(
+        MODEL_POOL,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "HTTP-Referer": referer_url,
+            "Content-Type": "application/json",
+        },
+        url=st.secrets.get("OPENROUTER_URL", DEFAULT_URL),
+        ttft_deadline=float(st.secrets.get("ROUTER_TTFT_DEADLINE", 20)),
+        hedge_after=float(hedge_after) if hedge_after else None,
+        recover_after=float(st.secrets.get("ROUTER_RECOVER_AFTER", 60)),
+    )
+
+@st.cache_resource
+def _scheduler():
+    """One scheduler per server process, so every session shares the key's rate limits."""
+    return RequestScheduler(
+        rpm=int(st.secrets.get("OPENROUTER_RPM", 60)),
+        tpm=int(st.secrets.get("OPENROUTER_TPM", 200_000)),
+        max_concurrency=int(st.secrets.get("OPENROUTER_CONCURRENCY", 4)),
+    )
+
+@st.cache_resource
+def _n_support():
+    """model -> whether the upstream honored `n` last time (shared by all sessions)."""
+    return {}
+
+@st.cache_resource
+def _length_stats():
+    """Observed reply lengths per mode/turn profile (shared by all sessions, kept on disk)."""
+    return LengthStats(LENGTH_STATS_PATH)
+
+def turn_job(payload, turn_mode, directives, sent_cap, profile, n_want=1, priority=INTERACTIVE):
+    """Job function generating one reply for `payload` through the shared router and scheduler."""
+    router = _router()  # resolve resources in the script thread; the job runs elsewhere
+    scheduler = _scheduler()
+    n_support = _n_support()
+    length_stats = _length_stats()
+    temp, story_max = sampling_for(turn_mode)
+    # learned p95 reply length once there are enough samples; Story never goes above its static budget
+    # (a long reply is continued anyway) and sentence caps still win inside run_turn
+    max_tokens = length_stats.limit(profile, default=story_max, ceiling=story_max)
+    # total budget for a Story reply including automatic continuations
+    story_total_max = int(st.secrets.get("STORY_CONTINUE_MAX_TOKENS", 4200))
+    story_max_parts = int(st.secrets.get("STORY_MAX_CONTINUATIONS", 3))
+
+    def _run_turn(job):
+        return run_turn(
+            job, payload, mode=turn_mode, directives=directives, sent_cap=sent_cap,
+            router=router, scheduler=scheduler, temperature=temp, max_tokens=max_tokens,
+            n_want=n_want, n_support=n_support, story_total_max=story_total_max,
+            story_max_parts=story_max_parts, priority=priority,
+            length_stats=length_stats, profile=profile,
+        )
+    return _run_turn
+
+# ---------------- Continue prefetch (Story) ----------------
+# After a Story reply, speculatively generate the next "continue" turn at background
+# priority. Every continue phrase ("continue", "keep going", ...) builds the identical
+# payload, so a matching prefetch can be handed over as the real turn; anything else
+# (or turning the toggle off) throws it away.
+def _payload_key(payload, n_want):
+    return hash(json.dumps([payload, n_want], sort_keys=True))
+
+def _prefetch_live(job):
+    return job is not None and not job.dismissed and not job.adopted
+
+def _prefetch_stats():
+    return st.session_state.setdefault("_prefetch_stats", {"started": 0, "hits": 0, "discarded": 0, "wasted_tokens": 0})
+
+def discard_prefetch():
+    """Cancel this chat's unused prefetch and count what it cost."""
+    rec = st.session_state.sessions[st.session_state.active_session]
+    for job in _jobs().for_chats([rec["id"]], kind="prefetch"):
+        if not _prefetch_live(job):
+            continue
+        job.dismissed = True
+        _jobs().cancel(job.id)
+        stats = _prefetch_stats()
+        stats["discarded"] += 1
+        stats["wasted_tokens"] += job.usage or len(job.text) // 4
+
+def adopt_prefetch(rec, payload, n_want):
+    """Turn a matching prefetch into this chat's real turn. Returns True on a hit."""
+    job = _jobs().latest(rec["id"], kind="prefetch")
+    if (not _prefetch_live(job) or job.status not in ("queued", "running", "done")
+            or job.branch != rec["tree"]["head"] or job.key != _payload_key(payload, n_want)):
+        return False
+    # its own flag: `dismissed` stays for the user's Keep/Discard on a stopped or failed turn
+    job.adopted = True
+    _prefetch_stats()["hits"] += 1
+    # the user is waiting on it now: jump the scheduler queue
+    job.priority = INTERACTIVE
+    for t in list(job.tickets):
+        _scheduler().promote(t, INTERACTIVE)
+    job.kind = "turn"
+    if job.status == "done":
+        # finished before anyone asked: show it right away
+        apply_finished_jobs()
+    return True
+
+def maybe_prefetch_continue():
+    """Start the next Story "continue" turn in the background if it is not running already."""
+    if not st.session_state.get("prefetch_continue") or st.session_state.mode != "Story":
+        discard_prefetch()  # toggled off or left Story: stop spending scheduler capacity on it
+        return
+    if st.session_state.edit_index is not None:
+        return
+    n_want = st.session_state.get("n_candidates", 1)
+    msgs = st.session_state.messages
+    if not msgs or msgs[-1].get("role") != "assistant" or n_want > 1:
+        return
+    rec = st.session_state.sessions[st.session_state.active_session]
+    if _jobs().active([rec["id"]]):
+        return
+    # what the continue payload depends on; only rebuild and hash it when this changed
+    canon_list = st.session_state.get("canon", [])
+    stamp = (rec["tree"]["head"], len(msgs), msgs[-1].get("content"), tuple(canon_list), n_want)
+    current = _jobs().latest(rec["id"], kind="prefetch")
+    if _prefetch_live(current) and st.session_state.get("_prefetch_stamp") == (current.id, stamp):
+        return
+    upcoming = msgs + [user_turn("continue")]
+    payload, sent_cap = build_payload("Story", upcoming, [], canon_list, {}, CANON_BUDGET)
+    key = _payload_key(payload, n_want)
+    if _prefetch_live(current):
+        if current.key == key and current.branch == rec["tree"]["head"]:
+            st.session_state._prefetch_stamp = (current.id, stamp)
+            return
+        discard_prefetch()  # the chat moved on (edit, branch switch, new canon...)
+    job = _jobs().submit(rec["id"], rec["tree"]["head"], turn_job(payload, "Story", [], sent_cap, "story/continue", priority=BACKGROUND),
+                         kind="prefetch", key=key)
+    st.session_state._prefetch_stamp = (job.id, stamp)
+    _prefetch_stats()["started"] += 1
 
 # hydrate from active chat record if missing (safety)
 rec = st.session_state.sessions[st.session_state.active_session]
 if "messages" not in st.session_state:
-    st.session_state.messages = rec["messages"].copy()
+    st.session_state.messages = history.materialize(rec["tree"])
 if "persona" not in st.session_state:
     st.session_state.persona = dict(rec.get("persona", {}))
 if "canon" not in st.session_state:
@@ -586,358 +709,68 @@ if st.session_state.pending_input is not None:
     raw_prompt = st.session_state.pending_input
     st.session_state.pending_input = None
 
-    # Parse markers FIRST
-    cleaned_prompt, per_turn_sysmsgs, directives = parse_markers(raw_prompt)
-    #st.write("DEBUG — directives found:", directives)
+    # Parse markers FIRST; the UI shows RAW (with brackets), the model gets CLEANED + directives
+    user_msg = user_turn(raw_prompt)
+    directives = user_msg["directives"]
 
-    # Show RAW (with brackets) in the UI; keep CLEANED + directives for the model
     if st.session_state.regen_from_idx is not None:
         reuse_idx = st.session_state.regen_from_idx
         st.session_state.messages = st.session_state.messages[:reuse_idx + 1]
-        st.session_state.messages[reuse_idx] = {
-            "role": "user_ui",
-            "content": raw_prompt,          # UI shows exactly what user typed (with brackets)
-            "cleaned": cleaned_prompt,      # for model
-            "raw": raw_prompt,              # keep for edits/regens
-            "directives": directives,       # for model
-        }
+        st.session_state.messages[reuse_idx] = user_msg
         st.session_state.regen_from_idx = None
     else:
-        st.session_state.messages.append({
-            "role": "user_ui",
-            "content": raw_prompt,          # UI shows brackets
-            "cleaned": cleaned_prompt,      # for model
-            "raw": raw_prompt,
-            "directives": directives,
-        })
+        st.session_state.messages.append(user_msg)
 
     # Literal short-circuit
     literal = directive_exact_reply(directives)
     if literal:
+        discard_prefetch()
         st.session_state.messages.append({"role": "assistant", "content": literal})
         save_session()
         st.session_state.just_responded = True
         st.session_state._scroll_to_bottom = True  
         st.rerun()
     
-# --- Build payload for the model ---
-
-   # Build the user message for the model
-    if st.session_state.mode == "Chat" and directives:
-        hidden_blob = "; ".join(d.strip() for d in directives if d.strip())
-        model_user_content = f"<hidden>{hidden_blob}</hidden>\n\n{cleaned_prompt or '(no explicit user text this turn)'}"
-    elif st.session_state.mode == "Story":
-        story_direction = (cleaned_prompt or "").strip()
-
-        simple_continue = story_direction.lower().rstrip(".!?") in {
-            "continue",
-            "keep going",
-            "go on",
-            "continue the story",
-        }
-
-        if simple_continue:
-            model_user_content = (
-                "Continue the ongoing story directly after the previous assistant response. "
-                "Do not recap, repeat, rewrite, or closely paraphrase any earlier passage. "
-                "Move the scene forward with new action, dialogue, decisions, discoveries, or consequences. "
-                "Preserve the established POV, tense, tone, characters, location, and continuity."
-            )
-        else:
-            model_user_content = (
-                "Treat the user's text below as direction for the next part of the same ongoing story. "
-                "Include every requested beat, fact, emotion, and dialogue cue. "
-                "Write fresh, polished prose rather than echoing the directions. "
-                "Invent natural in-character dialogue when speech is summarized. "
-                "Add fitting transitions, actions, reactions, and creative details. "
-                "Do not repeat or closely paraphrase any passage already written. "
-                "Move the story forward while preserving established POV, tense, tone, and continuity.\n\n"
-                f"STORY DIRECTION:\n{story_direction or '(continue naturally)'}"
-            )
-
-    else:
-        model_user_content = cleaned_prompt or "(no explicit user text this turn)"
-
-    
-    # Build a fresh payload from scratch:
-    payload = []
-    
-    # 1) Start with the single base system message (fresh every turn)
-    payload.append(_base_for(st.session_state.get("mode", "Chat")))
-    
-    # 2) Include prior conversation history BUT:
-    # --- cap history to avoid context overflow ---
-    # We re-add a fresh base system every turn, so trimming old messages is safe.
-    MAX_EXCHANGES = 60
-    
-    # Drop prior system messages (we'll re-add fresh system prompts below)
-    non_system = [m for m in st.session_state.messages if m.get("role") != "system"]
-    
-    # Keep only the tail: last N exchanges (~2 messages per exchange)
-    trimmed = non_system[-(MAX_EXCHANGES * 2 + 2):]
-    
-    msgs = trimmed
-    last_idx = len(msgs) - 1
-    
-    for i, m in enumerate(msgs):
-        role = m.get("role")
-    
-        # Skip the just-entered user turn; we add it once at the end as `model_user_content`
-        if i == last_idx and role == "user_ui":
-            continue
-    
-        if role == "user_ui":
-            payload.append({
-                "role": "user",
-                "content": m.get("cleaned") or m.get("content", "")
-            })
-        else:
-            payload.append(m)
-
-    
-    # 3) Append current per-turn system helpers (BEFORE the final user turn)
-    
-    # Canon memory (if any)
-    if st.session_state.get("canon"):
-        payload.append({
-            "role": "system",
-            "content": "CONTINUITY RECAP (for reference only, do not repeat to user):\n" + "\n".join(st.session_state.canon)
-        })
-    
-    # Persona (Chat only)
-    if st.session_state.mode == "Chat":
-        p = st.session_state.get("persona", {})
-        persona_bits = []
-        if p.get("who"):        persona_bits.append(f"Persona: {p['who']}")
-        if p.get("role"):       persona_bits.append(f"Voice/Role: {p['role']}")
-        if p.get("themes"):     persona_bits.append(f"Themes/Setting to keep present: {p['themes']}")
-        if p.get("boundaries"): persona_bits.append(f"Hard boundaries: {p['boundaries']}")
-        if persona_bits:
-            payload.append({
-                "role": "system",
-                "content": "CHAT MODE PERSISTENT PERSONA (do not state this aloud; just follow):\n" + "\n".join(persona_bits)
-            })
-        # Hard persona enforcement (addressing / honorifics)
-        pwho = (p.get("who") or "").lower()
-        if any(w in pwho for w in ["female", "woman", "girl", "she/her", "she / her", "she, her"]):
-            payload.append({
-                "role": "system",
-                "content": (
-                    "Address the user with feminine terms (she/her). "
-                    "Never use masculine terms like 'boy', 'man', 'sir', or 'good boy'. "
-                    "If prior context used them, correct silently and proceed."
-                )
-            })
-        elif any(w in pwho for w in ["male", "man", "boy", "he/him", "he / him", "he, him"]):
-            payload.append({
-                "role": "system",
-                "content": (
-                    "Address the user with masculine terms (he/him). "
-                    "Never use feminine terms like 'girl', 'ma'am', or 'good girl'. "
-                    "If prior context used them, correct silently and proceed."
-                )
-            })
-
-    # Mode rules
-    if st.session_state.mode == "Story":
-        payload.append({
-            "role": "system",
-            "content": (
-                "You are writing one continuous ongoing story. "
-                "Earlier assistant messages are established canon and are already included in the conversation history. "
-                "Continue directly from the exact endpoint of the previous response. "
-                "Never recap, repeat, rewrite, or closely paraphrase an earlier paragraph, action, sensation, or line of dialogue. "
-                "Every new paragraph must add something new: action, dialogue, information, a decision, a discovery, "
-                "a consequence, or a meaningful change in the scene. "
-                "If the user says only 'Continue,' advance the story naturally without waiting for additional direction. "
-                "Follow every specific beat the user provides while taking fitting creative liberties. "
-                "Preserve established POV, tense, tone, character knowledge, relationships, location, injuries, objects, "
-                "and emotional state. Use a smooth transition whenever the time or location genuinely changes. "
-                "Write immersive, creative prose with natural narrative momentum."
-            )
-        })
-
-    if st.session_state.mode == "Chat":
-        payload.append({"role": "system", "content": CHAT_GUIDE_RULE})
-        payload.append({"role": "system", "content": (
-            "Be creative, but keep the scene logically coherent. "
-            "Do not contradict established facts from earlier turns. "
-            "If the current scene implies a place, do not suddenly act from a different place. "
-            "If you need to change location or add a big step (e.g., going outside, driving somewhere), "
-            "first include a brief transition from the current situation, then continue. "
-            "Keep transitions short (one concise clause)."
-        )})
-    
-    # Bracket handler emphasis this turn (optional but helps)
-    sent_cap = None
-    if st.session_state.mode == "Chat" and directives:
-        sent_cap = _extract_length_hint_from_list(directives)
-        dir_text = "\n".join(f"- {d.strip()}" for d in directives if d.strip())
-        wants_clean = any(re.search(r"\b(non[-\s]?explicit|clean|pg)\b", d, re.I) for d in directives)
-        wants_explicit = any(re.search(r"\bexplicit\b", d, re.I) for d in directives)
-    
-        priority_lines = [
-            "THIS TURN ONLY — follow the hidden stage notes in the user's message.",
-            "Do NOT show, quote, paraphrase, or mention hidden text or instructions.",
-            "Integrate the stage directions exactly once, naturally (action as action, speech as spoken lines).",
-        ]
-        if sent_cap:
-            priority_lines.append(f"Keep the reply within {sent_cap} sentences.")
-        if wants_clean and not wants_explicit:
-            priority_lines.append("Keep language non‑explicit / PG for this turn.")
-    
-        payload.append({"role": "system", "content": "\n".join(priority_lines)})
-        payload.append({"role": "system", "content": HIDDEN_TAG_GUIDE})
-    
-    # Continuity anchor (Chat only)
-    if st.session_state.mode == "Chat":
-        last_beat = _last_assistant_text(st.session_state.messages)
-        if last_beat:
-            anchor = last_beat[-400:]
-            payload.append({
-                "role": "system",
-                "content": (
-                    "CONTINUITY ANCHOR (Chat mode):\n"
-                    "Stay in the same immediate scene (location, characters, objects, timeline) as the recent reply, "
-                    "unless the USER moves it. If you must change location/time, insert a brief transition FIRST "
-                    "(one short clause), then continue. No sudden teleports.\n\n"
-                    f"Recent scene excerpt:\n{anchor}"
-                )
-            })
-    
-    # 4) Final user turn — add it ONCE, AFTER all system instructions
-    payload.append({"role": "user", "content": model_user_content})
-
-    # Choose temp and token limit for Story mode
-    temp = 0.45 if st.session_state.mode == "Story" else 0.3
-    story_max = 1400 if st.session_state.mode == "Story" else None
-
-    # Build request body
-    body = {
-        "model": model,
-        "messages": payload,
-        "temperature": temp,
-    }
-    if sent_cap:
-        body["max_tokens"] = 140 if sent_cap <= 2 else 220
+    # --- Build payload for the model ---
+    payload, sent_cap = build_payload(
+        st.session_state.mode,
+        st.session_state.messages,
+        directives,
+        st.session_state.get("canon", []),
+        st.session_state.get("persona", {}),
+        CANON_BUDGET,
+    )
 
     # Keep the last few messages for debugging
     last_payload_tail = payload[-5:] if len(payload) > 5 else payload
     st.session_state.pop("last_error", None)  # clear old error
     
-    # Call API with one optional enforcement retry
-    def _call_openrouter(messages, temperature=0.4, max_tokens=None):
-        body_local = {
-            "model": model,
-            "messages": messages,
-            "temperature": temperature,
-        }
-    
-        if sent_cap:
-            body_local["max_tokens"] = 140 if sent_cap <= 2 else 220
-        elif max_tokens:
-            body_local["max_tokens"] = max_tokens
-    
-        resp = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "HTTP-Referer": referer_url,
-                "Content-Type": "application/json",
-            },
-            json=body_local,
-            timeout=60,
-        )
-        return resp
-
-    
-    try:
-        with st.spinner("Writing..."):
-            # First attempt
-            resp = _call_openrouter(payload, temperature=temp, max_tokens=story_max)
-    
-            if resp.status_code != 200:
-                st.error("❌ API REQUEST FAILED")
-                st.error(f"Status Code: {resp.status_code}")
-                st.code(resp.text)
-            
-                st.session_state.last_error = resp.text
-                st.session_state.just_responded = False
-                st.stop()
-            else:
-                data = resp.json()
+    st.session_state.last_debug = {"directives": directives, "payload_tail": last_payload_tail}
 
-                # 1. HARD ERROR CHECK
-                if "error" in data:
-                    st.error("OpenRouter returned an error")
-                    st.json(data["error"])
-                    st.stop()
-                
-                # 2. SAFE EXTRACTION
-                try:
-                    reply = data["choices"][0]["message"]["content"]
-                except Exception:
-                    st.error("Malformed response (no choices/message/content)")
-                    st.json(data)
-                    st.stop()
-                
-                # 3. EMPTY CHECK
-                if not reply or not isinstance(reply, str):
-                    st.error("Model returned empty content")
-                    st.json(data)
-                    st.stop()
-    
-                # If it violates bracket rules, retry once with stricter system + lower temp
-                if violates_bracket_rules(reply, directives) and st.session_state.mode == "Chat" and directives:
-                    strict_payload = []
-                    # keep everything up to (but not including) the final user turn
-                    strict_payload.extend(payload[:-1])
-                    strict_payload.append({
-                        "role": "system",
-                        "content": (
-                            "STRICT ENFORCEMENT FOR IMMEDIATE REWRITE (THIS TURN ONLY): "
-                            "Your previous draft failed to comply with the bracket rules. Rewrite now. "
-                            "Do NOT show, quote, or mention brackets. "
-                            "Integrate the stage directions exactly once, naturally (not necessarily first). "
-                            "If they imply speech, speak it as dialogue. If they imply action or mood, weave it into narration. "
-                            "No meta commentary."
-                        )
-                    })
-                    # re-append the same user turn with <hidden> stage notes
-                    strict_payload.append(payload[-1])
-    
-                    resp2 = _call_openrouter(strict_payload, temperature=0.2)
-                    if resp2.status_code == 200:
-                        reply2 = resp2.json()["choices"][0]["message"]["content"]
-                        # Prefer the second reply if it no longer violates
-                        if not violates_bracket_rules(reply2, directives):
-                            reply = reply2
-    
-                st.session_state.messages.append({"role": "assistant", "content": reply})
-                save_session()
-                st.session_state.just_responded = True
-                st.session_state._scroll_target = "bottom-anchor"
-                st.rerun()
-    
-    except Exception as e:
-        st.session_state.last_error = f"Request failed: {e}"
-        st.error("🔥 EXCEPTION OCCURRED")
-        st.code(str(e))
-        raise
-    finally:
-        st.session_state.just_responded = False
-# ---------------- Debug panel ----------------
-    if DEBUG:
-        st.subheader("Debug")
-        st.write("Directives parsed this turn:")
-        st.code(directives)
-        st.write("Payload tail (last ~5 messages sent to the model):")
-        st.code(last_payload_tail)
-        if "last_error" in st.session_state:
-            st.write("Last error:")
-            st.code(st.session_state.last_error)
+    # the user turn must be on disk before the job appends its reply there
+    save_session()
+    _rec = st.session_state.sessions[st.session_state.active_session]
+    n_want = st.session_state.get("n_candidates", 1)
+    if not adopt_prefetch(_rec, payload, n_want):
+        discard_prefetch()
+        # Call API with one optional enforcement retry -- in a background job, so the
+        # turn survives reruns, chat switches and reconnects
+        _jobs().submit(_rec["id"], _rec["tree"]["head"], turn_job(
+            payload, st.session_state.mode, directives, sent_cap,
+            length_profile(st.session_state.mode, user_msg["cleaned"], directives), n_want,
+        ))
+    st.session_state._scroll_target = "bottom-anchor"
+
+# Story: get the likely next "continue" going while the user reads
+maybe_prefetch_continue()
 
 # ---------------- Render ----------------
+# Background job state for this chat (a running job hides Edit/Regenerate/input)
+_chat_id = st.session_state.sessions[st.session_state.active_session]["id"]
+_my_chat_ids = [r["id"] for r in st.session_state.sessions.values()]
+_job = _jobs().latest(_chat_id)
+busy = _job is not None and _job.active
+
 # Prefill for Edit before any widgets render
 _pf = st.session_state.pop("_prefill", None)
 if _pf:
@@ -956,9 +789,6 @@ if st.session_state.get("edit_index") is not None:
         st.session_state[_k] = _txt
         st.session_state.edit_text = _txt
 
-def is_placeholder(msg):
-    return msg["role"] == "user" and msg["content"] == "(no explicit user text this turn)"
-
 # Robust last user like index
 last_user_like_idx = next(
     (i for i in range(len(st.session_state.messages) - 1, -1, -1)
@@ -984,57 +814,12 @@ for i, msg in enumerate(st.session_state.messages):
         # edit box, no value argument, key only
         st.session_state.edit_text = st.text_area("✏️ Edit message", key=f"edit_{i}")
     
-        # force scroll to the live edit box using a MutationObserver
-        _scroll_fix = st.empty()
-        with _scroll_fix:
-            components.html(
-                f"""
-                <script>
-                  const id = "edit-{i}";
-    
-                  // disable smooth behavior so the jump is instant
-                  try {{
-                    const d = window.parent && window.parent.document ? window.parent.document : document;
-                    d.documentElement.style.scrollBehavior = "auto";
-                    d.body.style.scrollBehavior = "auto";
-                  }} catch(e) {{}}
-    
-                  function jumpNow() {{
-                    try {{
-                      const doc = window.parent && window.parent.document ? window.parent.document : document;
-                      const el = doc.getElementById(id);
-                      if (el) {{
-                        el.scrollIntoView({{ block: "center" }});
-                        return true;
-                      }}
-                    }} catch(e) {{}}
-                    return false;
-                  }}
-    
-                  // try right away, then observe for layout changes
-                  if (!jumpNow()) {{
-                    const doc = window.parent && window.parent.document ? window.parent.document : document;
-                    const obs = new MutationObserver(() => {{
-                      if (jumpNow()) {{
-                        obs.disconnect();
-                      }}
-                    }});
-                    obs.observe(doc, {{ childList: true, subtree: true }});
-    
-                    // extra safety attempts
-                    let tries = 30;
-                    const t = setInterval(() => {{
-                      if (jumpNow() || --tries <= 0) clearInterval(t);
-                    }}, 50);
-                  }}
-                </script>
-                """,
-                height=0,
-            )
-    
         c1, c2 = st.columns([1, 1])
         with c1:
             if st.button("↩️ Resend", key=f"resend_{i}"):
+                record_action("edit", index=i, text=st.session_state.edit_text)
+                # keep the old continuation as a branch instead of throwing it away
+                fork_active_chat(i)
                 st.session_state.messages = st.session_state.messages[:i+1]
                 st.session_state.regen_from_idx = i
                 st.session_state.pending_input = st.session_state.edit_text
@@ -1054,21 +839,97 @@ for i, msg in enumerate(st.session_state.messages):
         st.chat_message(display_role).markdown(msg["content"])
 
         if role == "assistant":
+            cands = msg.get("candidates") or []
+            if len(cands) > 1:
+                chosen = st.radio(
+                    "Candidates",
+                    list(range(len(cands))),
+                    index=msg.get("chosen", 0),
+                    format_func=lambda k: f"#{k + 1}",
+                    horizontal=True,
+                    key=f"cand_{i}_{hash(tuple(cands))}",  # fresh widget per candidate set
+                )
+                if chosen != msg.get("chosen", 0):
+                    msg["chosen"] = chosen
+                    msg["content"] = cands[chosen]
+                    save_session()
+                    st.rerun()
+
             if st.button("📌 Pin this to canon", key=f"pin_{i}"):
-                pin_to_canon_safe(msg.get("content", ""))
+                record_action("pin", index=i)
+                outcome = pin_to_canon_safe(msg.get("content", ""))
+                if outcome:
+                    st.toast({"added": "📌 Pinned", "duplicate": "📌 Already in canon",
+                              "replaced": "📌 Canon note updated", "merged": "📌 Merged into an existing note"}[outcome])
                 save_session()
 
-        if editable and i == last_user_like_idx and st.session_state.edit_index is None:
+        if editable and i == last_user_like_idx and st.session_state.edit_index is None and not busy:
             if st.button("✏️ Edit", key=f"edit_{i}"):
+                discard_prefetch()
                 st.session_state._prefill = {"i": i, "text": msg.get("raw", msg["content"])}
                 st.session_state.edit_index = i
                 st.session_state._scroll_target = f"edit-{i}"
                 st.rerun()
 
+# ---------------- Generate ----------------
+@st.fragment(run_every=0.4)
+def _watch_jobs():
+    """Stream the active chat's reply; rerun the whole app once any of this session's jobs finishes."""
+    jobs = _jobs()
+    if not jobs.active(_my_chat_ids):
+        st.rerun()
+    job = jobs.latest(_chat_id)
+    if job is not None and job.active:
+        if job.queue_position:
+            st.info(f"⏳ Lots of people writing right now — you're #{job.queue_position} in line.")
+        st.chat_message("assistant").markdown(job.text + " ▌" if job.text else "✍️ Writing...")
+        if st.button("⏹ Stop", key=f"stop_{job.id}", help="Stop writing; you can keep what's there so far."):
+            record_action("stop", chars=len(job.text))
+            jobs.cancel(job.id)
+    others = len([j for j in jobs.active(_my_chat_ids) if j.chat_id != _chat_id])
+    if others:
+        st.caption(f"✍️ Still writing in {others} other chat(s)…")
+
+if _jobs().active(_my_chat_ids):
+    _watch_jobs()
+
+if _job is not None and not _job.dismissed:
+    if _job.status == "cancelled" and _job.text:
+        # Stopped mid-reply: offer to keep the partial text
+        st.chat_message("assistant").markdown(_job.text)
+        st.caption("⏹ Stopped before the reply finished.")
+        kc1, kc2 = st.columns(2)
+        with kc1:
+            if st.button("💾 Keep partial", key="keep_partial"):
+                record_action("keep_partial")
+                _job.dismissed = True
+                st.session_state.messages.append({"role": "assistant", "content": _job.text, "stopped": True, "job": _job.id})
+                save_session()
+                st.session_state._scroll_target = "bottom-anchor"
+                st.rerun()
+        with kc2:
+            if st.button("🗑️ Discard", key="discard_partial"):
+                _job.dismissed = True
+                st.rerun()
+    elif _job.status == "error":
+        err = _job.error
+        if isinstance(err, UpstreamError):
+            st.error("❌ API REQUEST FAILED")
+            st.error(f"Status Code: {err.status}")
+            st.code(err.text)
+            st.session_state.last_error = err.text
+        else:
+            st.session_state.last_error = f"Request failed: {err}"
+            st.error("🔥 EXCEPTION OCCURRED")
+            st.code(str(err))
+
 # Regenerate using the same user bubble
-if last_user_like_idx is not None and st.session_state.edit_index is None and st.session_state.pending_input is None:
+if last_user_like_idx is not None and st.session_state.edit_index is None and st.session_state.pending_input is None and not busy:
     if st.button("🔄 Regenerate Last Response"):
+        record_action("regenerate")
+        discard_prefetch()
         if last_user_like_idx + 1 < len(st.session_state.messages) and st.session_state.messages[last_user_like_idx + 1]["role"] == "assistant":
+            fork_active_chat(last_user_like_idx)
             st.session_state.messages = st.session_state.messages[:last_user_like_idx + 1]
         st.session_state.regen_from_idx = last_user_like_idx
         last_msg = st.session_state.messages[last_user_like_idx]
@@ -1077,39 +938,54 @@ if last_user_like_idx is not None and st.session_state.edit_index is None and st
         st.rerun()
 
 # Input box
-if st.session_state.edit_index is None and st.session_state.pending_input is None:
+if st.session_state.edit_index is None and st.session_state.pending_input is None and not busy:
     prompt = st.chat_input("Say something...")
     if prompt:
+        record_action("say", text=prompt, mode=st.session_state.mode, n_candidates=st.session_state.get("n_candidates", 1))
         st.session_state.pending_input = prompt
         st.session_state._scroll_target = "bottom-anchor"
         st.rerun()
         
-# While editing, force scroll to the edit box after it exists
-if st.session_state.get("edit_index") is not None:
-    _i = st.session_state.edit_index
-    st.components.v1.html(
-        f"""
-        <script>
-          const id = "edit-{_i}";
-          function jump() {{
-            try {{
-              const doc = window.parent && window.parent.document ? window.parent.document : document;
-              const el = doc.getElementById(id);
-              if (el) {{
-                el.scrollIntoView({{ block: "center" }});
-                return true;
-              }}
-            }} catch(e) {{}}
-            return false;
-          }}
-          let tries = 14;
-          const t = setInterval(() => {{
-            if (jump() || --tries <= 0) clearInterval(t);
-          }}, 120);
-        </script>
-        """,
-        height=0,
-    )
+# ---------------- Debug panel ----------------
+if st.session_state.get("_profiler") is not None:
+    st.session_state.last_profile = profiler.finish(st.session_state.pop("_profiler"))
+
+if DEBUG:
+    st.subheader("Debug")
+    last_debug = st.session_state.get("last_debug") or {}
+    st.write("Directives parsed last turn:")
+    st.code(last_debug.get("directives", []))
+    st.write("Payload tail (last ~5 messages sent to the model):")
+    st.code(last_debug.get("payload_tail", []))
+    st.write("Route taken last turn:")
+    st.code(_job.route if _job is not None else [])
+    st.write("Model pool (EWMA):")
+    st.code(_router().snapshot())
+    if st.secrets.get("WARMUP", True):
+        st.write("Warmup (once per server process):")
+        st.code(_warmup())
+    st.write("Request scheduler:")
+    st.code(_scheduler().stats())
+    st.write("Generation jobs (all sessions):")
+    st.code(_jobs().stats())
+    st.write("Reply lengths (completion tokens → max_tokens):")
+    st.code(_length_stats().snapshot())
+    pf = _prefetch_stats()
+    resolved = pf["hits"] + pf["discarded"]
+    st.write("Session memory (heavy state held by this tab, in bytes):")
+    st.code(_session_memory().resident(st.session_state))
+    st.write("Session memory (all tabs on this server):")
+    st.code(_session_memory().stats())
+    st.write("Continue prefetch (this session):")
+    st.code({**pf, "hit_rate": round(pf["hits"] / resolved, 2) if resolved else None})
+    prof = st.session_state.get("last_profile")
+    if prof:
+        st.write(f"Profiled rerun ({prof['total_s']}s) — top functions by cumulative time:")
+        st.dataframe(prof["rows"], hide_index=True)
+        st.download_button("⬇️ Download raw profile (.prof)", data=prof["raw"], file_name="rerun.prof", mime="application/octet-stream")
+    if "last_error" in st.session_state:
+        st.write("Last error:")
+        st.code(st.session_state.last_error)
 
 # Invisible anchor at the very bottom of the page
 st.markdown('<div id="bottom-anchor"></div>', unsafe_allow_html=True)
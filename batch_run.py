@@ -0,0 +1,226 @@
+"""
+Replay scripted conversations through the app's turn pipeline, without the UI.
+
+    python batch_run.py turns.jsonl --mock -o results.jsonl
+    python batch_run.py turns.jsonl --url https://openrouter.ai/api/v1/chat/completions -j 4
+
+Input is JSONL, one turn per line, grouped into conversations by the
+"conversation" field (turns run in file order within a conversation):
+
+    {"conversation": "c1", "mode": "Chat", "prompt": "hi [smile]",
+     "persona": {"who": "..."}, "canon": ["..."]}
+
+"mode" defaults to Chat. "persona" and "canon" carry over to later turns
+of the same conversation until a turn sets them again. Each turn goes
+through the same steps as a turn typed in app.py: parse_markers, the
+literal short-circuit, build_payload and run_turn (n-best, bracket
+retry, Story continuations). There is no adaptive max_tokens, so runs
+are reproducible.
+
+Conversations run side by side on a thread pool (or a process pool with
+--processes), at most -j at a time. Upstream calls go through a
+RequestScheduler, so rpm/tpm limits hold across conversations. With
+--processes every worker has its own scheduler. One JSON line per turn
+is written (reply, directives, compliance, route, timings, or the error
+that turn hit) plus a summary on stderr. A failing turn or worker never
+stops the rest of the batch.
+
+--mock starts mock_openrouter.py in-process, so no network or API key is
+needed.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from engine import (
+    base_for,
+    build_payload,
+    directive_exact_reply,
+    run_turn,
+    sampling_for,
+    user_turn,
+    violates_bracket_rules,
+)
+from jobs import Job
+from openrouter import DEFAULT_URL, ModelRouter
+from scheduler import RequestScheduler
+
+DEFAULT_MODEL = "thedrummer/skyfall-36b-v2"
+
+_shared = None  # (router, scheduler, n_support) for this process
+_shared_lock = threading.Lock()
+
+
+def _pipeline(opts):
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            router = ModelRouter(
+                opts["models"],
+                headers={
+                    "Authorization": f"Bearer {opts['api_key']}",
+                    "HTTP-Referer": opts["referer"],
+                    "Content-Type": "application/json",
+                },
+                url=opts["url"],
+                ttft_deadline=opts["ttft_deadline"],
+            )
+            scheduler = RequestScheduler(rpm=opts["rpm"], tpm=opts["tpm"], max_concurrency=opts["concurrency"])
+            _shared = (router, scheduler, {})
+        return _shared
+
+
+def load_conversations(path):
+    """{conversation id: [turn, ...]} in first-seen order."""
+    convs = {}
+    with open(path, "r") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            turn = json.loads(line)
+            if "prompt" not in turn:
+                raise ValueError(f"{path}:{n}: turn has no \"prompt\"")
+            convs.setdefault(str(turn.get("conversation", "default")), []).append(turn)
+    return convs
+
+
+def run_conversation(conv_id, turns, opts):
+    """Run one conversation's turns in order; returns one result dict per turn."""
+    router, scheduler, n_support = _pipeline(opts)
+    mode = turns[0].get("mode", "Chat")
+    messages = [base_for(mode)]
+    persona, canon_notes = {}, []
+    results = []
+    for idx, turn in enumerate(turns):
+        mode = turn.get("mode", mode)
+        persona = turn.get("persona", persona)
+        canon_notes = turn.get("canon", canon_notes)
+        user_msg = user_turn(turn["prompt"])
+        directives = user_msg["directives"]
+        messages.append(user_msg)
+        out = {"conversation": conv_id, "turn": idx, "mode": mode, "prompt": turn["prompt"],
+               "directives": directives}
+        started = time.monotonic()
+
+        literal = directive_exact_reply(directives)
+        if literal:
+            messages.append({"role": "assistant", "content": literal})
+            out.update(reply=literal, literal=True, elapsed_s=0.0)
+            results.append(out)
+            continue
+
+        payload, sent_cap = build_payload(mode, messages, directives, canon_notes, persona, opts["canon_budget"])
+        temp, story_max = sampling_for(mode)
+        job = Job(conv_id, "0", None)
+        try:
+            msg = run_turn(
+                job, payload, mode=mode, directives=directives, sent_cap=sent_cap,
+                router=router, scheduler=scheduler, temperature=temp, max_tokens=story_max,
+                n_want=opts["candidates"], n_support=n_support,
+                story_total_max=opts["story_total_max"], story_max_parts=opts["story_max_parts"],
+            )
+        except Exception as e:  # upstream errors, refused connections, timeouts...
+            out.update(error=str(e), error_type=type(e).__name__, route=job.route,
+                       elapsed_s=round(time.monotonic() - started, 3))
+            results.append(out)
+            continue  # like the app: the prompt stays, unanswered
+        messages.append(msg)
+        out.update(
+            reply=msg["content"],
+            literal=False,
+            sent_cap=sent_cap,
+            violates_bracket_rules=mode == "Chat" and violates_bracket_rules(msg["content"], directives),
+            candidates=len(msg.get("candidates") or []) or None,
+            continued=msg.get("continued", 0),
+            completion_tokens=job.usage,
+            route=job.route,
+            payload_messages=len(payload),
+            elapsed_s=round(time.monotonic() - started, 3),
+        )
+        results.append(out)
+    return results
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("turns", help="JSONL of turns")
+    ap.add_argument("-o", "--output", help="results JSONL (default: stdout)")
+    ap.add_argument("-j", "--jobs", type=int, default=4, help="conversations run at once")
+    ap.add_argument("--processes", action="store_true", help="use a process pool instead of threads")
+    ap.add_argument("--mock", action="store_true", help="serve replies from an in-process mock endpoint")
+    ap.add_argument("--mock-ttft", type=float, default=0.05)
+    ap.add_argument("--url", default=os.environ.get("OPENROUTER_URL", DEFAULT_URL))
+    ap.add_argument("--model", action="append", dest="models", help="model pool entry (repeatable)")
+    ap.add_argument("--candidates", type=int, default=1, help="replies sampled per turn")
+    ap.add_argument("--canon-budget", type=int, default=300)
+    ap.add_argument("--rpm", type=int, default=60)
+    ap.add_argument("--tpm", type=int, default=200_000)
+    ap.add_argument("--concurrency", type=int, default=4, help="upstream calls in flight")
+    ap.add_argument("--ttft-deadline", type=float, default=20.0)
+    args = ap.parse_args(argv)
+
+    opts = {
+        "models": args.models or [DEFAULT_MODEL],
+        "api_key": os.environ.get("OPENROUTER_API_KEY", "batch"),
+        "referer": os.environ.get("REFERER_URL", "http://localhost"),
+        "url": args.url,
+        "ttft_deadline": args.ttft_deadline,
+        "rpm": args.rpm,
+        "tpm": args.tpm,
+        "concurrency": args.concurrency,
+        "candidates": args.candidates,
+        "canon_budget": args.canon_budget,
+        "story_total_max": 4200,
+        "story_max_parts": 3,
+    }
+    if args.mock:
+        import mock_openrouter
+        opts["url"] = mock_openrouter.serve(ttft=args.mock_ttft).url
+
+    convs = load_conversations(args.turns)
+    out = open(args.output, "w") if args.output else sys.stdout
+    pool_cls = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    started = time.monotonic()
+    latencies, errors, turns = [], 0, 0
+    try:
+        with pool_cls(max_workers=args.jobs) as pool:
+            futures = {pool.submit(run_conversation, cid, t, opts): cid for cid, t in convs.items()}
+            for fut in as_completed(futures):
+                try:
+                    rows = fut.result()
+                except Exception as e:  # the conversation itself broke (or its worker process died)
+                    rows = [{"conversation": futures[fut], "error": str(e), "error_type": type(e).__name__}]
+                for row in rows:
+                    turns += 1
+                    errors += "error" in row
+                    if not row.get("literal") and row.get("elapsed_s") is not None:
+                        latencies.append(row["elapsed_s"])
+                    out.write(json.dumps(row) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    wall = time.monotonic() - started
+    print(
+        f"{len(convs)} conversations, {turns} turns, {errors} errors in {wall:.1f}s "
+        f"({turns / wall if wall else 0:.1f} turns/s); turn latency p50={_percentile(latencies, 0.5)}s "
+        f"p95={_percentile(latencies, 0.95)}s",
+        file=sys.stderr,
+    )
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
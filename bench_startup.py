@@ -0,0 +1,129 @@
+"""
+What does the first user after a deploy wait for?
+
+    python bench_startup.py --runs 5
+    python bench_startup.py --chats 200 --messages 400 --connect-delay 0.3 --compare
+
+Each run restarts the app: a fresh `streamlit run app.py` process in a
+scratch directory (see loadtest.AppServer) with a synthetic sessions.json,
+against mock_openrouter.py. `--connect-delay` makes every new upstream
+connection cost that much, like a TLS handshake to openrouter.ai. Then one
+headless client measures:
+
+  ready_s         process start until /_stcore/health answers
+  first_render_s  websocket connect + first script run (first load of the chat index)
+  first_turn_s    first Chat turn, send until the reply has settled
+  second_*        the same for a second tab right after (what warm caches buy)
+
+With --compare, every run is repeated with WARMUP = false for an A/B.
+Medians over --runs are printed; --json writes every run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import history
+import mock_openrouter
+import storage
+from engine import base_for, user_turn
+from loadtest import AppServer, Session
+
+
+def synthetic_index(path, chats, messages):
+    """A sessions.json with `chats` chats of `messages` messages each."""
+    base = base_for("Chat")
+    sessions = {}
+    for c in range(chats):
+        rec = storage.new_record(base)
+        msgs = [base]
+        for m in range(messages):
+            if m % 2 == 0:
+                msgs.append(user_turn(f"chat {c} turn {m} [smile] what happens next?"))
+            else:
+                msgs.append({"role": "assistant", "content": f"Reply {m}. " + "The rain kept falling on the quiet street. " * 12})
+        history.commit(rec["tree"], msgs)
+        sessions[f"Chat {c + 1}"] = rec
+    storage.save_sessions(path, sessions)
+
+
+async def _tab(url, opts, idx):
+    stats = {"reruns": [], "turns": [], "errors": [], "script_runs": 0}
+    tab = Session(idx, url, opts, stats)
+    started = time.monotonic()
+    await tab.connect()
+    await tab.rerun()
+    render = time.monotonic() - started
+    try:
+        await tab.choose("radio", "Mode", "Chat")
+        await tab.turn(0)
+    finally:
+        await tab.close()
+    return render, stats["turns"][0]
+
+
+def run_once(index_path, mock, opts, warmup):
+    app = AppServer(mock.url, opts, secrets={"WARMUP": warmup}, files={"sessions.json": index_path})
+    try:
+        first_render, first_turn = asyncio.run(_tab(app.ws_url, opts, 0))
+        second_render, second_turn = asyncio.run(_tab(app.ws_url, opts, 1))
+    finally:
+        app.stop()
+    return {
+        "warmup": warmup,
+        "ready_s": round(app.ready_s, 3),
+        "first_render_s": round(first_render, 3),
+        "first_turn_s": round(first_turn, 3),
+        "second_render_s": round(second_render, 3),
+        "second_turn_s": round(second_turn, 3),
+    }
+
+
+def _medians(rows):
+    keys = [k for k in rows[0] if k.endswith("_s")]
+    return {k: round(statistics.median(r[k] for r in rows), 3) for k in keys}
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--runs", type=int, default=3, help="restarts per configuration")
+    ap.add_argument("--chats", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=200, help="messages per chat")
+    ap.add_argument("--ttft", type=float, default=0.3, help="mock seconds before the first token")
+    ap.add_argument("--token-delay", type=float, default=0.0, help="mock seconds between words")
+    ap.add_argument("--connect-delay", type=float, default=0.2, help="mock seconds per new connection")
+    ap.add_argument("--compare", action="store_true", help="also run with WARMUP = false")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--json", help="also write every run here")
+    args = ap.parse_args(argv)
+    # poll the writing fragment faster than the page's 0.4s so turn times aren't rounded up to it
+    opts = {"rpm": 100_000, "concurrency": 8, "timeout": args.timeout, "poll": 0.05}
+
+    mock = mock_openrouter.serve(ttft=args.ttft, token_delay=args.token_delay, connect_delay=args.connect_delay)
+    fd, index_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    synthetic_index(index_path, args.chats, args.messages)
+    print(f"sessions.json: {args.chats} chats x {args.messages} messages, "
+          f"{os.path.getsize(index_path) / 2**20:.1f} MB", file=sys.stderr)
+
+    results = []
+    try:
+        for warmup in ([True, False] if args.compare else [True]):
+            rows = [run_once(index_path, mock, opts, warmup) for _ in range(args.runs)]
+            results += rows
+            print(f"WARMUP={str(warmup).lower():<5} " + "  ".join(f"{k} {v}" for k, v in _medians(rows).items()),
+                  flush=True)
+    finally:
+        os.remove(index_path)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
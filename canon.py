@@ -0,0 +1,133 @@
+"""
+Canon (pinned continuity notes) under a token budget.
+
+- Pinning goes through `add_entry`: character-shingle MinHash signatures catch
+  near-duplicates (dropped, or replaced when the new one says more) and
+  overlapping entries (merged sentence by sentence, newer wording wins).
+- `consolidate` runs the same merge over a whole list, for canon edited by
+  hand or pinned before this existed.
+- `select` ranks entries by relevance to the current turn and keeps the
+  best ones that fit the budget, so only those are injected as the
+  CONTINUITY RECAP.
+
+Token counts are the same ~4 characters/token estimate used elsewhere.
+"""
+import hashlib
+import re
+
+NUM_PERM = 64
+SHINGLE = 5  # characters, over the normalized words
+DUPLICATE = 0.8  # estimated Jaccard at/above which two entries say the same thing
+OVERLAP = 0.3  # ... at/above which they are merged into one
+RESTATED = 0.5  # share of an old sentence's shingles found in the new entry for it to be dropped on merge
+
+_PRIME = (1 << 61) - 1
+_COEFFS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _PRIME or 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _PRIME)
+    for i in range(NUM_PERM)
+]
+_WORD = re.compile(r"[a-z0-9']+")
+_SENTENCE = re.compile(r"(?<=[.!?])\s+")
+_STOP = {"the", "a", "an", "and", "or", "but", "to", "of", "in", "on", "at", "is", "was", "it", "he", "she",
+         "they", "his", "her", "their", "with", "for", "as", "that", "this", "be", "by", "from"}
+
+
+def estimate_tokens(text):
+    return max(1, len(text or "") // 4)
+
+
+def _words(text):
+    return _WORD.findall((text or "").lower())
+
+
+def shingles(text, k=SHINGLE):
+    norm = " ".join(_words(text))
+    if len(norm) <= k:
+        return {norm} if norm else set()
+    return {norm[i:i + k] for i in range(len(norm) - k + 1)}
+
+
+def signature(text):
+    """MinHash signature of the entry's shingles."""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles(text)]
+    if not hashes:
+        return [_PRIME] * NUM_PERM
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _COEFFS]
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / NUM_PERM
+
+
+def _merge(old, new):
+    """Sentences of `old` not restated in `new`, then `new` (newer facts win)."""
+    new_sh = shingles(new)
+    kept = []
+    for sentence in _SENTENCE.split(old):
+        sh = shingles(sentence)
+        if sh and len(sh & new_sh) / len(sh) < RESTATED:
+            kept.append(sentence.strip())
+    return " ".join(kept + [new.strip()]).strip()
+
+
+def add_entry(canon, text):
+    """
+    Pin `text`. Returns (new canon list, what happened): "added",
+    "duplicate" (already there), "replaced" or "merged".
+    """
+    text = (text or "").strip()
+    if not text:
+        return list(canon), "duplicate"
+    sig = signature(text)
+    best, best_sim = None, 0.0
+    for i, entry in enumerate(canon):
+        sim = similarity(sig, signature(entry))
+        if sim > best_sim:
+            best, best_sim = i, sim
+    out = list(canon)
+    if best is not None and best_sim >= DUPLICATE:
+        if estimate_tokens(text) <= estimate_tokens(out[best]):
+            return out, "duplicate"
+        out.pop(best)
+        return out + [text], "replaced"
+    if best is not None and best_sim >= OVERLAP:
+        merged = _merge(out.pop(best), text)
+        return out + [merged], "merged"
+    return out + [text], "added"
+
+
+def consolidate(canon):
+    """Re-pin every entry in order, folding duplicates and overlaps together."""
+    out = []
+    for entry in canon:
+        out, _ = add_entry(out, entry)
+    return out
+
+
+def select(canon, context, budget):
+    """
+    The entries to inject this turn: ranked by word overlap with `context`
+    (the turn being answered plus the latest reply), newer first on ties,
+    kept while they fit in `budget` tokens. Returned in canon order.
+    """
+    if not canon:
+        return []
+    total = sum(estimate_tokens(e) for e in canon)
+    if budget is None or total <= budget:
+        return list(canon)
+    ctx = set(_words(context)) - _STOP
+
+    def score(i):
+        words = set(_words(canon[i])) - _STOP
+        hits = len(words & ctx) / (len(words) or 1)
+        return (hits, i)  # later pins are fresher
+
+    chosen, used = [], 0
+    for i in sorted(range(len(canon)), key=score, reverse=True):
+        cost = estimate_tokens(canon[i])
+        if used + cost <= budget:
+            chosen.append(i)
+            used += cost
+    return [canon[i] for i in sorted(chosen)]
@@ -0,0 +1,228 @@
+"""
+Record upstream traffic to a cassette and serve it back later.
+
+Recording (opt-in): `install(path)` makes every `openrouter.Stream` log its
+request body, status, headers, each SSE line with its time offset and the
+error that ended it, if any.
+The app turns it on with the RECORD_CASSETTE secret and also logs the UI
+actions that caused the calls (say / edit / regenerate / pin / stop), so
+a production session can be replayed step by step (see replay_ui.py).
+
+A cassette is JSONL with two kinds of line:
+
+    {"kind": "call", "t": ..., "url": ..., "request": {...}, "status": 200,
+     "headers": {...}, "ttfb": 0.41, "chunks": [[0.43, "data: {...}"], ...],
+     "body": "...", "error": null, "aborted": false}
+    {"kind": "action", "t": ..., "action": "say", "text": "hi [smile]", "mode": "Chat"}
+
+Replaying: `serve(path, latency_scale=1.0)` starts a stub endpoint that
+answers each request with the recorded call for the same messages (in
+recorded order when the same messages were sent more than once, e.g.
+hedges or retries), with the recorded timing scaled by `latency_scale`.
+
+    python cassette.py session.jsonl --port 8001 --latency-scale 0.5
+"""
+import argparse
+import collections
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openrouter
+
+
+class Trace:
+    """One recorded upstream call, written out when it ends."""
+
+    def __init__(self, recorder, url, body):
+        self.recorder = recorder
+        self.started = time.monotonic()
+        self.entry = {"kind": "call", "t": time.time(), "url": url, "request": body,
+                      "status": None, "headers": {}, "ttfb": None, "chunks": [], "body": None, "error": None, "aborted": False}
+        self.finished = False
+
+    def _now(self):
+        return round(time.monotonic() - self.started, 4)
+
+    def response(self, status, headers):
+        self.entry["status"] = status
+        self.entry["ttfb"] = self._now()
+        self.entry["headers"] = {k: v for k, v in headers.items() if k.lower() in ("retry-after", "content-type")}
+
+    def chunk(self, line):
+        if line:
+            self.entry["chunks"].append([self._now(), line])
+
+    def finish(self, body=None, aborted=False, error=None):
+        """`error`: the connection failure, or the error event that ended the stream."""
+        if self.finished:
+            return
+        self.finished = True
+        self.entry["body"] = body
+        self.entry["error"] = error
+        self.entry["aborted"] = aborted
+        self.recorder.write(self.entry)
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def start(self, url, body):
+        return Trace(self, url, body)
+
+    def action(self, action, **data):
+        self.write(dict({"kind": "action", "t": time.time(), "action": action}, **data))
+
+    def write(self, entry):
+        with self._lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def install(path):
+    """Record every upstream call made in this process to `path` (appending)."""
+    openrouter.recorder = Recorder(path)
+    return openrouter.recorder
+
+
+def load(path):
+    """(calls, actions) from a cassette, each in recorded order."""
+    calls, actions = [], []
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                (calls if entry.get("kind") == "call" else actions).append(entry)
+    return calls, actions
+
+
+def request_key(body):
+    """
+    What a replayed request is matched on: the messages and the sampling
+    knobs. Not the model (the router may pick another) and not max_tokens
+    (learned per install, see length_stats.py).
+    """
+    sig = {k: body.get(k) for k in ("messages", "n", "temperature")}
+    return hashlib.sha1(json.dumps(sig, sort_keys=True).encode()).hexdigest()
+
+
+# ---------------- Replay server ----------------
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def _send(self, status, raw, headers):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        call = server.next_call(body)
+        if call is None:
+            server.misses += 1
+            raw = json.dumps({"error": {"code": 404, "message": "no recorded call for this request"}}).encode()
+            return self._send(404, raw, {"Content-Type": "application/json"})
+        server.hits += 1
+        scale = server.latency_scale
+        time.sleep((call.get("ttfb") or 0) * scale)
+        if call.get("status") is None and call.get("error"):
+            # the recorded call never got a response (refused, reset, timed out): hang up the same way
+            self.close_connection = True
+            return
+        headers = dict(call.get("headers") or {})
+        if call.get("status") != 200 or not call.get("chunks"):
+            raw = (call.get("body") or "").encode()
+            return self._send(call.get("status") or 502, raw, headers or {"Content-Type": "application/json"})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        clock = call.get("ttfb") or 0
+        try:
+            for at, line in call["chunks"]:
+                time.sleep(max(0.0, at - clock) * scale)
+                clock = at
+                raw = f"{line}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+                self.wfile.flush()
+            if not call.get("aborted") and not call["chunks"][-1][1].endswith("[DONE]"):
+                raw = b"data: [DONE]\n\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            server.aborted += 1
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, calls, latency_scale=1.0, loose=False):
+        super().__init__(addr, _Handler)
+        self.latency_scale = latency_scale
+        self.loose = loose
+        self.hits = self.misses = self.aborted = 0
+        self._lock = threading.Lock()
+        self._by_key = collections.defaultdict(collections.deque)
+        self._rest = collections.deque(calls)
+        for call in calls:
+            self._by_key[request_key(call["request"])].append(call)
+
+    def next_call(self, body):
+        """The recorded call for this request; with `loose`, the next unserved one when nothing matches."""
+        with self._lock:
+            queue = self._by_key.get(request_key(body))
+            if queue:
+                call = queue.popleft()
+                self._rest.remove(call)
+            elif self.loose and self._rest:
+                call = self._rest.popleft()
+                self._by_key[request_key(call["request"])].remove(call)
+            else:
+                return None
+            return call
+
+
+def serve(path, port=0, host="127.0.0.1", latency_scale=1.0, loose=False):
+    """Start a replay endpoint for cassette `path` in a daemon thread and return the server."""
+    calls, _ = load(path)
+    server = ReplayServer((host, port), calls, latency_scale, loose)
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("cassette")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8001)
+    ap.add_argument("--latency-scale", type=float, default=1.0, help="0.5 = twice as fast, 0 = no delays")
+    ap.add_argument("--loose", action="store_true", help="answer unmatched requests with the next recorded call")
+    args = ap.parse_args(argv)
+    server = serve(args.cassette, args.port, args.host, args.latency_scale, args.loose)
+    print(f"replaying {args.cassette} on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
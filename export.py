@@ -0,0 +1,149 @@
+"""
+Export a chat as Markdown, plain text or EPUB without building the transcript in memory.
+
+Messages come one at a time from `history.iter_messages`. Each format is a
+generator of small text chunks (Markdown, text), or writes chapter entries
+straight into the zip (EPUB), so memory stays flat however long the story
+is. `export_file` streams the result into a temporary file for download.
+
+System messages and directive-only placeholders are left out; user turns
+are exported without their [bracket] directives.
+"""
+import html
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+
+import history
+from engine import is_placeholder
+
+# label -> (file extension, mime type)
+FORMATS = {
+    "Markdown": ("md", "text/markdown"),
+    "Text": ("txt", "text/plain"),
+    "EPUB": ("epub", "application/epub+zip"),
+}
+TURNS_PER_CHAPTER = 100  # EPUB: readers choke on one giant XHTML file
+
+
+def turns(tree, bid=None, include_user=True):
+    """Yield ("user" | "assistant", text) for every exportable message on branch `bid` (default: head)."""
+    for msg in history.iter_messages(tree, bid):
+        role = msg["role"]
+        if role == "system" or is_placeholder(msg):
+            continue
+        if role in ("user_ui", "user"):
+            if not include_user:
+                continue
+            text = msg.get("cleaned", msg["content"])
+            role = "user"
+        else:
+            text = msg["content"]
+        text = (text or "").strip()
+        if text:
+            yield role, text
+
+
+def markdown_chunks(title, items):
+    yield f"# {title}\n\n"
+    for role, text in items:
+        if role == "user":
+            quoted = "\n> ".join(text.splitlines())
+            yield f"> **You:** {quoted}\n\n"
+        else:
+            yield f"{text}\n\n"
+
+
+def text_chunks(title, items):
+    yield f"{title}\n{'=' * len(title)}\n\n"
+    for role, text in items:
+        yield f"You: {text}\n\n" if role == "user" else f"{text}\n\n"
+
+
+# ---------------- EPUB ----------------
+_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>
+"""
+_XHTML_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">
+<head><meta charset="utf-8"/><title>{title}</title>
+<style>blockquote.you {{ font-style: italic; color: #555; }}</style></head>
+<body>
+"""
+_XHTML_TAIL = "</body>\n</html>\n"
+
+
+def _paragraphs(text):
+    return "".join(f"<p>{html.escape(p.strip())}</p>\n" for p in re.split(r"\n\s*\n", text) if p.strip())
+
+
+def write_epub(fp, title, items, uid=None, per_chapter=TURNS_PER_CHAPTER):
+    """Write an EPUB 3 book to the binary file `fp`, one chapter entry per `per_chapter` turns."""
+    uid = uid or uuid.uuid4().hex
+    esc_title = html.escape(title)
+    chapters = 0
+    with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        z.writestr("META-INF/container.xml", _CONTAINER)
+        out, in_chapter = None, 0
+        for role, text in items:
+            if out is None:
+                chapters += 1
+                out = z.open(f"OEBPS/chapter-{chapters:04d}.xhtml", "w")
+                out.write(_XHTML_HEAD.format(title=f"{esc_title} — {chapters}").encode())
+                if chapters == 1:
+                    out.write(f"<h1>{esc_title}</h1>\n".encode())
+            body = _paragraphs(text)
+            out.write((f'<blockquote class="you">{body}</blockquote>\n' if role == "user" else body).encode())
+            in_chapter += 1
+            if in_chapter >= per_chapter:
+                out.write(_XHTML_TAIL.encode())
+                out.close()
+                out, in_chapter = None, 0
+        if out is not None:
+            out.write(_XHTML_TAIL.encode())
+            out.close()
+        if not chapters:  # nothing to export: still a valid (empty) book
+            chapters = 1
+            z.writestr("OEBPS/chapter-0001.xhtml", _XHTML_HEAD.format(title=esc_title) + f"<h1>{esc_title}</h1>\n" + _XHTML_TAIL)
+
+        ids = [f"chapter-{n:04d}" for n in range(1, chapters + 1)]
+        z.writestr("OEBPS/nav.xhtml", (
+            _XHTML_HEAD.format(title=esc_title)
+            + '<nav epub:type="toc"><ol>\n'
+            + "".join(f'<li><a href="{i}.xhtml">Part {n}</a></li>\n' for n, i in enumerate(ids, 1))
+            + "</ol></nav>\n" + _XHTML_TAIL
+        ))
+        modified = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        z.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            f'<dc:identifier id="uid">urn:uuid:{uuid.UUID(hex=uid)}</dc:identifier>\n'
+            f"<dc:title>{esc_title}</dc:title>\n<dc:language>en</dc:language>\n"
+            f'<meta property="dcterms:modified">{modified}</meta>\n</metadata>\n<manifest>\n'
+            '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>\n'
+            + "".join(f'<item id="{i}" href="{i}.xhtml" media-type="application/xhtml+xml"/>\n' for i in ids)
+            + "</manifest>\n<spine>\n"
+            + "".join(f'<itemref idref="{i}"/>\n' for i in ids)
+            + "</spine>\n</package>\n"
+        ))
+
+
+def export_file(tree, fmt, title, include_user=True, uid=None):
+    """Stream the head branch of `tree` in format `fmt` into a temp file; returns it rewound (deleted on close)."""
+    ext, _ = FORMATS[fmt]
+    fp = tempfile.TemporaryFile(suffix=f".{ext}")
+    items = turns(tree, include_user=include_user)
+    if fmt == "EPUB":
+        write_epub(fp, title, items, uid)
+    else:
+        for chunk in (markdown_chunks if fmt == "Markdown" else text_chunks)(title, items):
+            fp.write(chunk.encode("utf-8"))
+    fp.seek(0)
+    return fp
@@ -0,0 +1,108 @@
+"""
+Branching chat history.
+
+A chat is stored as a small tree of branches instead of one flat list.
+Each branch keeps only the messages it added after forking from its
+parent ("delta"); the shared prefix lives once, in the ancestors:
+
+    {"branches": {"0": {"parent": None, "fork": 0, "delta": [...]},
+                  "1": {"parent": "0", "fork": 4, "delta": [...]}},
+     "head": "1",
+     "next": 2}
+
+Branch "1" is `materialize(tree, "0")[:4] + delta`. Forks are always
+attached to the deepest ancestor whose own range contains the fork
+point, so fork offsets strictly increase along any path and
+materializing a branch is one walk up its parents plus one pass over
+the messages.
+"""
+
+
+def new_tree(messages):
+    """Fresh single-branch tree holding `messages`."""
+    return {
+        "branches": {"0": {"parent": None, "fork": 0, "delta": list(messages)}},
+        "head": "0",
+        "next": 1,
+    }
+
+
+def _chain(tree, bid):
+    """Branch ids from the root down to `bid` (O(depth))."""
+    branches = tree["branches"]
+    chain = []
+    while bid is not None:
+        chain.append(bid)
+        bid = branches[bid]["parent"]
+    chain.reverse()
+    return chain
+
+
+def iter_messages(tree, bid=None):
+    """Yield the messages of branch `bid` (default: head) without building a list."""
+    branches = tree["branches"]
+    chain = _chain(tree, tree["head"] if bid is None else bid)
+    for pos, cid in enumerate(chain):
+        b = branches[cid]
+        if pos + 1 < len(chain):
+            # only the part of this branch that the child actually shares
+            take = branches[chain[pos + 1]]["fork"] - b["fork"]
+            yield from b["delta"][:take]
+        else:
+            yield from b["delta"]
+
+
+def materialize(tree, bid=None):
+    """Full message list for branch `bid` (default: head)."""
+    return list(iter_messages(tree, bid))
+
+
+def commit(tree, messages):
+    """Store a working copy of the head branch back into the tree (delta only)."""
+    head = tree["branches"][tree["head"]]
+    head["delta"] = list(messages[head["fork"]:])
+
+
+def fork(tree, at):
+    """
+    Start a new branch that shares messages[:at] with the current head and
+    make it the head. The old continuation stays intact on its own branch.
+    Returns the new branch id.
+    """
+    branches = tree["branches"]
+    parent = tree["head"]
+    # climb until the fork point lies inside the parent's own delta
+    while branches[parent]["parent"] is not None and at <= branches[parent]["fork"]:
+        parent = branches[parent]["parent"]
+    bid = str(tree["next"])
+    tree["next"] += 1
+    branches[bid] = {"parent": parent, "fork": at, "delta": []}
+    tree["head"] = bid
+    return bid
+
+
+def append(tree, bid, msg):
+    """Append one message to the end of branch `bid`."""
+    tree["branches"][bid]["delta"].append(msg)
+
+
+def branch_length(tree, bid=None):
+    """Number of messages on branch `bid` without materializing it."""
+    b = tree["branches"][tree["head"] if bid is None else bid]
+    return b["fork"] + len(b["delta"])
+
+
+def branch_label(tree, bid):
+    """Short human label for the branch picker."""
+    b = tree["branches"][bid]
+    size = branch_length(tree, bid)
+    if b["parent"] is None:
+        return f"Original ({size} msgs)"
+    preview = ""
+    for m in b["delta"]:
+        if m.get("role") in ("user_ui", "user"):
+            preview = (m.get("raw") or m.get("content") or "").strip().replace("\n", " ")
+            break
+    if len(preview) > 40:
+        preview = preview[:40] + "…"
+    return f"Branch {bid} · from msg {b['fork']} · {size} msgs" + (f" · {preview}" if preview else "")
@@ -0,0 +1,121 @@
+"""
+Background generation jobs.
+
+A turn used to run inline in the Streamlit script, so switching chats or a
+websocket reconnect mid-request lost the reply (or appended it to the
+wrong chat). Now each turn is a `Job` on a process-wide thread pool,
+keyed by the chat's stable id and the branch it answers. When the job
+finishes, `on_done(job)` persists the reply to that chat record; the UI
+only polls the job table to stream progress and to fold finished replies
+into its own copy of the chats.
+
+Job functions receive the job itself so they can report progress
+(`job.partial`, `job.queue_position`) and watch `job.cancel_event`.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    def __init__(self, chat_id, branch, fn, kind="turn", key=None):
+        self.id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.branch = branch
+        self.kind = kind
+        self.key = key  # caller-defined identity, e.g. which payload a prefetch answers
+        self.fn = fn
+        self.status = "queued"  # queued -> running -> done | error | cancelled
+        self.partial = []  # streamed text of the reply so far
+        self.queue_position = 0  # >0 while waiting on the request scheduler
+        self.result = None  # the assistant message dict on success
+        self.error = None
+        self.route = []
+        self.usage = 0  # completion tokens spent, when the job function reports it
+        self.priority = None  # scheduler priority of the job's upstream calls
+        self.tickets = []  # scheduler tickets currently awaited
+        self.cancel_event = threading.Event()
+        self.dismissed = False  # a cancelled/failed job the user has dealt with
+        self.adopted = False  # a prefetch taken over as the real turn
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def text(self):
+        return "".join(self.partial)
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+
+class JobManager:
+    def __init__(self, max_workers=8, on_done=None, keep_seconds=3600):
+        self.on_done = on_done
+        self.keep_seconds = keep_seconds
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gen-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, chat_id, branch, fn, kind="turn", key=None):
+        job = Job(chat_id, branch, fn, kind, key)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def for_chats(self, chat_ids, kind="turn"):
+        """Jobs for any of `chat_ids`, oldest first."""
+        chat_ids = set(chat_ids)
+        with self._lock:
+            return [j for j in self._jobs.values() if j.chat_id in chat_ids and j.kind == kind]
+
+    def latest(self, chat_id, kind="turn"):
+        jobs = self.for_chats([chat_id], kind)
+        return jobs[-1] if jobs else None
+
+    def active(self, chat_ids, kind="turn"):
+        return [j for j in self.for_chats(chat_ids, kind) if j.active]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+        return job
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for j in self._jobs.values():
+                counts[j.status] = counts.get(j.status, 0) + 1
+            return counts
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        for jid in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[jid]
+
+    def _run(self, job):
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            job.finished = time.time()
+            return
+        job.status = "running"
+        try:
+            job.result = job.fn(job)
+            if self.on_done is not None:
+                self.on_done(job)
+        except BaseException as e:
+            job.error = e
+            job.status = "cancelled" if job.cancel_event.is_set() else "error"
+        else:
+            job.status = "done"
+        finally:
+            job.queue_position = 0
+            job.finished = time.time()
@@ -0,0 +1,86 @@
+"""
+Observed reply lengths, used to pick `max_tokens` per turn.
+
+Each reply's completion-token count is recorded under a profile (mode +
+what kind of turn it was, see `engine.length_profile`). Once a profile
+has enough samples, `limit()` returns a high percentile of them plus some
+headroom instead of the static default. A reply cut off at the limit is a
+censored sample (its true length is unknown), so when too many recent
+replies hit the limit the cap widens instead of ratcheting down.
+
+Shared by every session in the process and kept in a small JSON file so
+it survives restarts.
+"""
+import json
+import math
+import os
+import threading
+
+
+class LengthStats:
+    def __init__(self, path=None, window=200, min_samples=20, percentile=0.95, headroom=1.2, floor=64):
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.headroom = headroom
+        self.floor = floor
+        self._lock = threading.Lock()
+        self._samples = {}  # profile -> [[tokens, truncated], ...] (oldest first)
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self._samples = json.load(f)
+            except (OSError, ValueError):
+                self._samples = {}
+
+    def record(self, profile, tokens, truncated=False):
+        if not tokens:
+            return
+        with self._lock:
+            samples = self._samples.setdefault(profile, [])
+            samples.append([int(tokens), bool(truncated)])
+            del samples[:-self.window]
+            self._save()
+
+    def _quantile(self, samples):
+        tokens = sorted(t for t, _ in samples)
+        return tokens[min(len(tokens) - 1, math.ceil(self.percentile * len(tokens)) - 1)]
+
+    def limit(self, profile, default=None, ceiling=None):
+        """max_tokens for the next `profile` turn, or `default` until there are enough samples."""
+        with self._lock:
+            samples = list(self._samples.get(profile, []))
+        if len(samples) < self.min_samples:
+            return default
+        cap = self._quantile(samples) * self.headroom
+        cut = sum(1 for _, truncated in samples if truncated) / len(samples)
+        if cut > 1 - self.percentile:
+            # we've been cutting replies short, so the samples understate them: widen
+            cap = max(t for t, _ in samples) * 1.5
+        cap = max(self.floor, int(cap))
+        return min(cap, ceiling) if ceiling else cap
+
+    def snapshot(self):
+        """Per-profile summary for the Debug panel."""
+        with self._lock:
+            profiles = {p: list(s) for p, s in self._samples.items()}
+        out = {}
+        for p, samples in profiles.items():
+            tokens = sorted(t for t, _ in samples)
+            out[p] = {
+                "n": len(samples),
+                "p50": tokens[len(tokens) // 2],
+                f"p{round(self.percentile * 100)}": self._quantile(samples),
+                "truncated": sum(1 for _, truncated in samples if truncated),
+                "limit": self.limit(p),
+            }
+        return out
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._samples, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,360 @@
+"""
+How many concurrent users can one server process carry?
+
+    python loadtest.py --sessions 1,4,8,16 --turns 4
+    python loadtest.py --sessions 8 --ttft 1.5 --token-delay 0.02 --json report.json
+
+For each N it starts `streamlit run app.py` (fresh, in a scratch directory,
+pointed at mock_openrouter.py) and connects N headless clients to it over
+the same websocket protocol a browser tab uses. So the sessions share the
+server's cache_resource router/scheduler/job pool like real users would.
+AppTest can't be used here: it drives the script in its own process and
+isn't safe to run from several threads at once.
+
+Each client types a turn and polls the writing fragment the way the page
+does until the reply settles. Then it pins the reply. Every other turn it
+opens a new chat and switches back.
+
+Reported per N:
+  - rerun latency percentiles (an interaction until its script runs settle)
+  - turn latency (send until the reply has settled)
+  - throughput
+  - server memory per session (RSS growth / N, after a warm-up run)
+  - the server's peak thread count
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import mock_openrouter
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def proc_status(pid):
+    """{"rss_mb": ..., "threads": ...} for a process (Linux /proc; zeros elsewhere)."""
+    out = {"rss_mb": 0.0, "threads": 0}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    out["rss_mb"] = int(line.split()[1]) / 1024
+                elif line.startswith("Threads:"):
+                    out["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+    return out
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# ---------------- Server under test ----------------
+class AppServer:
+    """
+    `streamlit run app.py` in a scratch directory with its own secrets.toml.
+    `secrets` adds entries to it; `files` ({name: source path}) are copied in first.
+    """
+
+    def __init__(self, mock_url, opts, secrets=None, files=None):
+        self.scratch = tempfile.mkdtemp(prefix="loadtest-")  # sessions.json etc. stay out of the checkout
+        os.makedirs(os.path.join(self.scratch, ".streamlit"))
+        for name, src in (files or {}).items():
+            shutil.copy(src, os.path.join(self.scratch, name))
+        with open(os.path.join(self.scratch, ".streamlit", "secrets.toml"), "w") as f:
+            f.write(
+                'OPENROUTER_API_KEY = "load"\n'
+                'REFERER_URL = "http://localhost"\n'
+                f'OPENROUTER_URL = "{mock_url}"\n'
+                f'OPENROUTER_RPM = {opts["rpm"]}\n'
+                f'OPENROUTER_CONCURRENCY = {opts["concurrency"]}\n'
+            )
+            for key, value in (secrets or {}).items():
+                f.write(f"{key} = {json.dumps(value)}\n")
+        self.port = _free_port()
+        self.started = time.monotonic()
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "streamlit", "run", APP,
+             "--server.headless", "true",
+             "--server.address", "127.0.0.1",
+             "--server.port", str(self.port),
+             "--server.fileWatcherType", "none",
+             "--browser.gatherUsageStats", "false"],
+            cwd=self.scratch, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        self.ws_url = f"ws://127.0.0.1:{self.port}/_stcore/stream"
+        deadline = time.monotonic() + 60
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"streamlit exited: {self.proc.stderr.read().decode()[-2000:]}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/_stcore/health", timeout=1):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("streamlit didn't come up within 60s")
+                time.sleep(0.05)
+        self.ready_s = time.monotonic() - self.started
+
+    def status(self):
+        return proc_status(self.proc.pid)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+# ---------------- One headless tab ----------------
+class Session:
+    """Speaks the browser side of Streamlit's websocket protocol, just enough to use app.py."""
+
+    def __init__(self, idx, url, opts, stats):
+        self.idx = idx
+        self.url = url
+        self.stats = stats
+        self.timeout = opts["timeout"]
+        self.poll = opts.get("poll")  # seconds between fragment reruns; None = the page's own timer
+        self.elements = []  # (fragment id or "", element) from the latest runs
+        self.values = {}  # widget id -> WidgetState the page would keep sending (radio, selectbox)
+        self.auto = {}  # fragment id -> seconds between the page's automatic fragment reruns
+        self.ws = None
+
+    async def connect(self):
+        import websockets
+
+        self.ws = await websockets.connect(self.url, subprotocols=["streamlit"], max_size=None)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+
+    async def rerun(self, trigger=None, fragment_id=""):
+        """Send one rerun (with `trigger` as a one-shot widget state) and wait until the runs it causes settle."""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        msg = BackMsg()
+        cs = msg.rerun_script
+        cs.fragment_id = fragment_id
+        cs.is_auto_rerun = bool(fragment_id)
+        states = dict(self.values)
+        if trigger is not None:
+            states[trigger.id] = trigger
+        cs.widget_states.widgets.extend(states.values())
+
+        started = time.monotonic()
+        await self.ws.send(msg.SerializeToString())
+        while True:
+            raw = await asyncio.wait_for(self.ws.recv(), self.timeout)
+            fwd = ForwardMsg()
+            fwd.ParseFromString(raw)
+            kind = fwd.WhichOneof("type")
+            if kind == "new_session":
+                self.stats["script_runs"] += 1
+                frags = set(fwd.new_session.fragment_ids_this_run)
+                if frags:
+                    self.elements = [(f, e) for f, e in self.elements if f not in frags]
+                else:
+                    self.elements, self.auto = [], {}
+            elif kind == "delta" and fwd.delta.WhichOneof("type") == "new_element":
+                el = fwd.delta.new_element
+                if el.WhichOneof("type") == "exception":
+                    raise RuntimeError(f"app raised {el.exception.type}: {el.exception.message}")
+                self.elements.append((fwd.delta.fragment_id, el))
+            elif kind == "auto_rerun":
+                self.auto[fwd.auto_rerun.fragment_id] = fwd.auto_rerun.interval
+            elif kind == "stop_auto_rerun":
+                self.auto.clear()
+            elif kind == "script_finished":
+                status = fwd.script_finished
+                if status == ForwardMsg.FINISHED_WITH_COMPILE_ERROR:
+                    raise RuntimeError("app failed to compile")
+                if status != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                    break  # an st.rerun() means another run follows
+        self.stats["reruns"].append(time.monotonic() - started)
+
+    # ---- widgets ----
+    def widget(self, kind, label=None):
+        found = None
+        for _, el in self.elements:
+            if el.WhichOneof("type") == kind:
+                w = getattr(el, kind)
+                if label is None or w.label == label:
+                    found = w  # last one wins (e.g. the newest reply's pin button)
+        return found
+
+    async def click(self, label):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        button = self.widget("button", label)
+        if button is None:
+            return False
+        await self.rerun(WidgetState(id=button.id, trigger_value=True))
+        return True
+
+    async def choose(self, kind, label, option):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        w = self.widget(kind, label)
+        state = WidgetState(id=w.id, string_value=option)
+        self.values[w.id] = state
+        await self.rerun(state)
+
+    # ---- what a user does ----
+    async def settle(self):
+        """Run the writing fragment on the page's timer until it stops asking to be rerun."""
+        deadline = time.monotonic() + self.timeout
+        while self.auto:
+            if time.monotonic() > deadline:
+                raise TimeoutError("reply didn't settle")
+            fragment_id, interval = next(iter(self.auto.items()))
+            await asyncio.sleep(self.poll or interval)
+            await self.rerun(fragment_id=fragment_id)
+
+    async def turn(self, n):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        box = self.widget("chat_input")
+        if box is None:
+            raise RuntimeError("no chat input on the page")
+        started = time.monotonic()
+        state = WidgetState(id=box.id)
+        state.chat_input_value.data = f"session {self.idx} turn {n} [smile]"
+        await self.rerun(state)
+        await self.settle()
+        self.stats["turns"].append(time.monotonic() - started)
+
+    async def new_chat_and_back(self):
+        picker = self.widget("selectbox", "Active Chat")
+        here = picker.options[picker.default] if picker is not None else None
+        await self.click("+ New Chat")
+        if here is not None:
+            await self.choose("selectbox", "Active Chat", here)
+
+    async def main(self, turns):
+        try:
+            await self.connect()
+            await self.rerun()
+            await self.choose("radio", "Mode", "Chat")
+            for n in range(turns):
+                await self.turn(n)
+                await self.click("📌 Pin this to canon")
+                if n % 2:
+                    await self.new_chat_and_back()
+        except Exception as e:
+            self.stats["errors"].append(f"session {self.idx}: {type(e).__name__}: {e}")
+        finally:
+            await self.close()
+
+
+# ---------------- Levels ----------------
+async def _drive(n, url, opts, stats):
+    sessions = [Session(i, url, opts, stats) for i in range(n)]
+    await asyncio.gather(*(s.main(opts["turns"]) for s in sessions))
+
+
+def run_level(n, opts, mock):
+    app = AppServer(mock.url, opts)
+    try:
+        # one throwaway page load so imports and cache_resource singletons aren't billed to the sessions
+        warm = {"reruns": [], "turns": [], "errors": [], "script_runs": 0}
+        asyncio.run(_drive(1, app.ws_url, dict(opts, turns=0), warm))
+        before = app.status()
+
+        peak_threads = [before["threads"]]
+        done = threading.Event()
+
+        def watch():
+            while not done.wait(0.1):
+                peak_threads[0] = max(peak_threads[0], app.status()["threads"])
+
+        monitor = threading.Thread(target=watch, daemon=True)
+        monitor.start()
+        stats = {"reruns": [], "turns": [], "errors": warm["errors"], "script_runs": 0}
+        requests_before = mock.requests
+        started = time.monotonic()
+        asyncio.run(_drive(n, app.ws_url, opts, stats))
+        wall = time.monotonic() - started
+        done.set()
+        after = app.status()
+    finally:
+        app.stop()
+    return {
+        "sessions": n,
+        "wall_s": round(wall, 2),
+        "turns": len(stats["turns"]),
+        "turns_per_s": round(len(stats["turns"]) / wall, 2),
+        "reruns_per_s": round(len(stats["reruns"]) / wall, 2),
+        "script_runs": stats["script_runs"],
+        "rerun_p50_s": percentile(stats["reruns"], 0.5),
+        "rerun_p95_s": percentile(stats["reruns"], 0.95),
+        "rerun_p99_s": percentile(stats["reruns"], 0.99),
+        "turn_p50_s": percentile(stats["turns"], 0.5),
+        "turn_p95_s": percentile(stats["turns"], 0.95),
+        "rss_mb": round(after["rss_mb"], 1),
+        "rss_per_session_mb": round(max(0.0, after["rss_mb"] - before["rss_mb"]) / n, 2),
+        "peak_threads": peak_threads[0],
+        "upstream_requests": mock.requests - requests_before,
+        "errors": stats["errors"],
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--sessions", default="1,2,4,8", help="comma-separated N values to try")
+    ap.add_argument("--turns", type=int, default=4, help="turns per session")
+    ap.add_argument("--ttft", type=float, default=0.3, help="mock seconds before the first token")
+    ap.add_argument("--token-delay", type=float, default=0.005, help="mock seconds between words")
+    ap.add_argument("--rpm", type=int, default=100_000, help="scheduler limit (high: measure the app, not the limiter)")
+    ap.add_argument("--concurrency", type=int, default=64, help="scheduler upstream calls in flight")
+    ap.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for a rerun or a reply")
+    ap.add_argument("--json", help="also write the results here")
+    args = ap.parse_args(argv)
+    opts = {"turns": args.turns, "rpm": args.rpm, "concurrency": args.concurrency, "timeout": args.timeout}
+
+    mock = mock_openrouter.serve(ttft=args.ttft, token_delay=args.token_delay)
+    results = []
+    for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+        res = run_level(n, opts, mock)
+        results.append(res)
+        print(
+            f"N={n:<3} {res['turns_per_s']:>6} turns/s  {res['reruns_per_s']:>7} reruns/s  "
+            f"rerun p50/p95/p99 {res['rerun_p50_s']}/{res['rerun_p95_s']}/{res['rerun_p99_s']}s  "
+            f"turn p50/p95 {res['turn_p50_s']}/{res['turn_p95_s']}s  "
+            f"{res['rss_per_session_mb']} MB/session  {res['peak_threads']} threads  "
+            f"{len(res['errors'])} errors",
+            flush=True,
+        )
+        for err in res["errors"][:5]:
+            print(f"    {err}", file=sys.stderr)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+Local stand-in for OpenRouter's /chat/completions, for offline runs.
+
+    python mock_openrouter.py --port 8001 --ttft 0.4 --token-delay 0.02
+    python mock_openrouter.py --port 8002 --ttft 6 --error-rate 0.3
+
+Speaks enough of the real API for this app: streamed (SSE) and plain
+JSON replies, `n` choices, `max_tokens` truncation with
+finish_reason="length", usage counts, and injected latency (also per
+new connection, like a TLS handshake), errors and 429s with Retry-After. Replies are deterministic filler built from the
+last user message, so runs are reproducible.
+
+`serve(port, **opts)` starts one in a background thread (port 0 picks a
+free port) and returns the server; `server.url` is its endpoint.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = (
+    "the rain kept falling on the quiet street while she waited by the door "
+    "listening for footsteps that never came and the lamp flickered once"
+).split()
+
+
+def _reply_words(messages, seed):
+    last = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    head = f"(mock #{seed}) Re: {' '.join(last.split()[:8])}".split()
+    rng = random.Random(f"{last}|{seed}")
+    return head + [rng.choice(_WORDS) for _ in range(240)] + ["The", "end."]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def handle(self):
+        # stands in for DNS/TCP/TLS setup, paid once per new connection
+        time.sleep(self.server.opts["connect_delay"])
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass  # client dropped a kept-alive connection
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _json(self, status, obj, headers=None):
+        raw = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_POST(self):
+        opts = self.server.opts
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.server.requests += 1
+        rng = self.server.rng
+        if opts["rate_limit_every"] and self.server.requests % opts["rate_limit_every"] == 0:
+            return self._json(429, {"error": {"code": 429, "message": "mock rate limit"}},
+                              {"Retry-After": str(opts["retry_after"])})
+        if rng.random() < opts["error_rate"]:
+            time.sleep(opts["ttft"] / 2)
+            return self._json(502, {"error": {"code": 502, "message": "mock upstream error"}})
+
+        model = opts["model"] or body.get("model", "mock")
+        n = int(body.get("n") or 1) if opts["honor_n"] else 1
+        limit = body.get("max_tokens") or 10_000
+        choices = []
+        for i in range(n):
+            words = _reply_words(body.get("messages") or [], i)
+            cut = words[:limit]
+            choices.append((cut, "length" if len(words) > limit else "stop"))
+        usage = {
+            "prompt_tokens": sum(len((m.get("content") or "").split()) for m in body.get("messages") or []),
+            "completion_tokens": sum(len(c) for c, _ in choices),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        time.sleep(opts["ttft"])
+
+        if not body.get("stream"):
+            time.sleep(opts["token_delay"] * max(len(c) for c, _ in choices))
+            return self._json(200, {
+                "id": "mock", "model": model, "usage": usage,
+                "choices": [{"index": i, "message": {"role": "assistant", "content": " ".join(c)},
+                             "finish_reason": fr} for i, (c, fr) in enumerate(choices)],
+            })
+
+        # chunked like the real API, so clients see each event as soon as it is written
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(text):
+            raw = text.encode()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(raw), raw))
+            self.wfile.flush()
+
+        try:
+            event(": OPENROUTER PROCESSING\n\n")
+            for pos in range(max(len(c) for c, _ in choices)):
+                time.sleep(opts["token_delay"])
+                deltas = [{"index": i, "delta": {"content": (" " if pos else "") + c[pos]}}
+                          for i, (c, _) in enumerate(choices) if pos < len(c)]
+                event(f"data: {json.dumps({'model': model, 'choices': deltas})}\n\n")
+            final = {"model": model, "usage": usage,
+                     "choices": [{"index": i, "delta": {}, "finish_reason": fr} for i, (_, fr) in enumerate(choices)]}
+            event(f"data: {json.dumps(final)}\n\n")
+            event("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.server.aborted += 1  # client hung up (Stop / lost hedge)
+
+
+DEFAULTS = {
+    "ttft": 0.2,
+    "token_delay": 0.0,
+    "error_rate": 0.0,
+    "rate_limit_every": 0,
+    "retry_after": 1,
+    "honor_n": True,
+    "model": None,
+    "seed": 0,
+    "connect_delay": 0.0,
+}
+
+
+def serve(port=0, host="127.0.0.1", **opts):
+    """Start a mock endpoint in a daemon thread and return the server."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.opts = dict(DEFAULTS, **opts)
+    server.rng = random.Random(server.opts["seed"])
+    server.requests = 0
+    server.aborted = 0
+    server.url = f"http://{host}:{server.server_address[1]}/api/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8001)
+    ap.add_argument("--ttft", type=float, default=DEFAULTS["ttft"], help="seconds before the first token")
+    ap.add_argument("--token-delay", type=float, default=DEFAULTS["token_delay"], help="seconds between words")
+    ap.add_argument("--error-rate", type=float, default=DEFAULTS["error_rate"], help="fraction of 502 answers")
+    ap.add_argument("--rate-limit-every", type=int, default=0, help="answer every Nth request with 429")
+    ap.add_argument("--retry-after", type=float, default=DEFAULTS["retry_after"])
+    ap.add_argument("--no-n", action="store_true", help="ignore the `n` parameter like some providers do")
+    ap.add_argument("--model", help="report this model name instead of echoing the request")
+    ap.add_argument("--connect-delay", type=float, default=0.0, help="extra seconds per new connection (like a TLS handshake)")
+    args = ap.parse_args(argv)
+    server = serve(
+        args.port, args.host, ttft=args.ttft, token_delay=args.token_delay, error_rate=args.error_rate,
+        rate_limit_every=args.rate_limit_every, retry_after=args.retry_after, honor_n=not args.no_n,
+        model=args.model, connect_delay=args.connect_delay,
+    )
+    print(f"mock OpenRouter listening on {server.url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
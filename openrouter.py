@@ -0,0 +1,377 @@
+"""
+OpenRouter client: streamed chat completions plus a small routing layer.
+
+`ModelRouter.complete()` sends one request body to an ordered pool of
+models. It keeps per-model EWMA stats (time to first token and error
+rate) and uses them to
+
+- try healthy, fast models first (the configured order is the tiebreak),
+- give up on a model that has not produced a first token within
+  `ttft_deadline` seconds and fall back to the next one,
+- optionally hedge: after `hedge_after` seconds without a first token,
+  start the next model in parallel and keep whichever speaks first.
+
+A model that misses the TTFT deadline, or whose error rate or TTFT goes
+over the limit, is demoted for `recover_after` seconds and then tried
+again; failing that probe demotes it for another window. 429s are rate
+limits, not model failures (the scheduler backs off for those), and don't
+count as errors.
+
+Every attempt is appended to `Completion.route`, which the app shows in
+its Debug panel. Nothing here imports Streamlit, so the router can be
+exercised against local stubs (see mock_openrouter.py).
+"""
+import json
+import queue
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+DEFAULT_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+_http = requests.Session()
+
+recorder = None  # set by cassette.install() to log every call
+
+
+def preconnect(urls, timeout=5):
+    """
+    Open one keep-alive connection per upstream host in the shared pool, so
+    the first real call skips DNS, TCP and TLS setup. Failures are ignored.
+    """
+    for origin in sorted({"{0.scheme}://{0.netloc}".format(urlsplit(u)) for u in urls}):
+        try:
+            _http.head(f"{origin}/", timeout=timeout).close()
+        except requests.RequestException:
+            pass
+
+
+class UpstreamError(Exception):
+    """Non-200 answer (or an error chunk) from the upstream API."""
+
+    def __init__(self, status, text, retry_after=None, model=None):
+        super().__init__(f"{model or 'upstream'} returned {status}: {text[:200]}")
+        self.status = status
+        self.text = text
+        self.retry_after = retry_after
+        self.model = model
+
+
+class Cancelled(Exception):
+    """The caller asked us to stop before the reply was finished."""
+
+
+class Completion:
+    """A finished (possibly multi-choice) reply."""
+
+    def __init__(self, model, choices, finish_reasons, usage, ttft, elapsed):
+        self.model = model
+        self.choices = choices
+        self.finish_reasons = finish_reasons
+        self.usage = usage or {}
+        self.ttft = ttft
+        self.elapsed = elapsed
+        self.route = []
+
+    @property
+    def text(self):
+        return self.choices[0] if self.choices else ""
+
+    @property
+    def finish_reason(self):
+        return self.finish_reasons[0] if self.finish_reasons else None
+
+
+def _retry_after(resp):
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+
+class Stream:
+    """One streamed request. Iterate it for (choice_index, text) deltas."""
+
+    def __init__(self, url, headers, body, timeout=60):
+        self.url = url
+        self.headers = headers
+        self.body = dict(body, stream=True)
+        self.timeout = timeout
+        self.model = body.get("model")
+        self.resp = None
+        self.finish_reasons = {}
+        self.usage = {}
+        self._closed = False
+        self._lock = threading.Lock()  # close() vs. open() handing over the response
+        self.trace = None
+
+    def open(self):
+        if recorder is not None:
+            self.trace = recorder.start(self.url, self.body)
+        try:
+            resp = _http.post(self.url, headers=self.headers, json=self.body, stream=True, timeout=self.timeout)
+        except Exception as e:
+            if self.trace is not None:
+                self.trace.finish(error=f"{type(e).__name__}: {e}")
+            raise
+        with self._lock:
+            self.resp = resp
+            closed = self._closed
+        if closed:
+            # stopped while waiting for the headers: hang up now instead of letting upstream finish the reply
+            resp.close()
+            raise Cancelled()
+        if self.trace is not None:
+            self.trace.response(self.resp.status_code, self.resp.headers)
+        if self.resp.status_code != 200:
+            text = self.resp.text
+            if self.trace is not None:
+                self.trace.finish(text)
+            self.close()
+            raise UpstreamError(self.resp.status_code, text, _retry_after(self.resp), self.model)
+        self.resp.encoding = "utf-8"
+        return self
+
+    def __iter__(self):
+        # chunk_size=None: hand over bytes as they arrive instead of buffering 512 at a time
+        lines = self.resp.iter_lines(chunk_size=None, decode_unicode=True)
+        for line in lines:
+            if self._closed:
+                raise Cancelled()
+            if self.trace is not None:
+                self.trace.chunk(line)
+            # blank keep-alives and ": OPENROUTER PROCESSING" comments
+            if not line or line.startswith(":") or not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                if self.trace is not None:
+                    self.trace.finish()
+                # read to the end of the body so the connection goes back to the pool for the next call
+                for _ in lines:
+                    pass
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                err = chunk["error"] or {}
+                if self.trace is not None:
+                    self.trace.finish(error=json.dumps(err))
+                raise UpstreamError(err.get("code", 500), json.dumps(err), model=self.model)
+            if chunk.get("usage"):
+                self.usage = chunk["usage"]
+            for ch in chunk.get("choices") or []:
+                idx = ch.get("index", 0)
+                if ch.get("finish_reason"):
+                    self.finish_reasons[idx] = ch["finish_reason"]
+                text = (ch.get("delta") or {}).get("content")
+                if text:
+                    yield idx, text
+        if self._closed:
+            raise Cancelled()
+        if self.trace is not None:
+            self.trace.finish()
+
+    def close(self):
+        """Abort the request; closing the response drops the socket so upstream stops generating."""
+        if self.trace is not None:
+            self.trace.finish(aborted=True)
+        with self._lock:
+            self._closed = True
+            resp = self.resp
+        if resp is not None:
+            try:
+                resp.close()
+            except Exception:
+                pass
+
+
+class _ModelStats:
+    def __init__(self):
+        self.ttft = None  # EWMA seconds
+        self.errors = 0.0  # EWMA of 0/1 failures
+        self.calls = 0
+        self.demoted_until = 0.0  # monotonic time; ranked last until then
+
+    def observe(self, ok, ttft, alpha):
+        self.calls += 1
+        self.errors = (1 - alpha) * self.errors + alpha * (0.0 if ok else 1.0)
+        if ok and ttft is not None:
+            self.ttft = ttft if self.ttft is None else (1 - alpha) * self.ttft + alpha * ttft
+
+
+class ModelRouter:
+    """
+    pool: list of model names, or dicts {"model": ..., "url": ...} when
+    models live behind different endpoints (handy for local stubs).
+    """
+
+    def __init__(self, pool, headers, url=DEFAULT_URL, ttft_deadline=20.0, hedge_after=None,
+                 max_error_rate=0.5, alpha=0.3, timeout=60, recover_after=60.0):
+        self.pool = [p if isinstance(p, dict) else {"model": p} for p in pool]
+        self.headers = headers
+        self.url = url
+        self.ttft_deadline = ttft_deadline
+        self.hedge_after = hedge_after
+        self.max_error_rate = max_error_rate
+        self.alpha = alpha
+        self.timeout = timeout
+        self.recover_after = recover_after
+        self.stats = {p["model"]: _ModelStats() for p in self.pool}
+        self._lock = threading.Lock()
+
+    def ranked(self):
+        """Pool order, with demoted (erroring, too slow or hung) models pushed to the back."""
+        now = time.monotonic()
+
+        def penalty(entry):
+            return (self.stats[entry[1]["model"]].demoted_until > now, entry[0])
+        with self._lock:
+            return [p for _, p in sorted(enumerate(self.pool), key=penalty)]
+
+    def snapshot(self):
+        """Per-model stats for the Debug panel."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                m: {"calls": s.calls, "ttft_ewma": None if s.ttft is None else round(s.ttft, 2),
+                    "error_rate": round(s.errors, 2),
+                    "demoted_s": round(max(0.0, s.demoted_until - now), 1)}
+                for m, s in self.stats.items()
+            }
+
+    def _observe(self, model, ok, ttft, missed_deadline=False):
+        with self._lock:
+            s = self.stats[model]
+            s.observe(ok, ttft, self.alpha)
+            slow = s.ttft is not None and s.ttft > self.ttft_deadline
+            if missed_deadline or (not ok and s.errors > self.max_error_rate) or (ok and slow):
+                # sit out a recovery window; the first call after it is the probe
+                s.demoted_until = time.monotonic() + self.recover_after
+
+    def _attempt(self, stream, events):
+        """Run one model in a worker thread, reporting progress on `events`."""
+        texts = {}
+        started = time.monotonic()
+        try:
+            stream.open()
+            for idx, text in stream:
+                if not texts:
+                    events.put(("first", stream, time.monotonic() - started))
+                texts[idx] = texts.get(idx, "") + text
+                events.put(("delta", stream, (idx, text)))
+            n = max(texts) + 1 if texts else 0
+            done = Completion(
+                stream.model,
+                [texts.get(i, "") for i in range(n)],
+                [stream.finish_reasons.get(i) for i in range(n)],
+                stream.usage,
+                None,
+                time.monotonic() - started,
+            )
+            events.put(("done", stream, done))
+        except Exception as e:
+            events.put(("error", stream, e))
+
+    def complete(self, body, on_delta=None, cancel=None):
+        """
+        Stream one reply, routing across the pool. `on_delta(choice_index, text)`
+        is called for the winning model only. Set the `cancel` event to abort.
+        """
+        order = self.ranked()
+        events = queue.Queue()
+        route = []
+        active = {}  # stream -> {"model", "start", "first"}
+        winner = None
+        last_error = None
+        started = time.monotonic()
+
+        def launch(reason):
+            entry = order.pop(0)
+            stream = Stream(entry.get("url", self.url), self.headers, dict(body, model=entry["model"]), self.timeout)
+            active[stream] = {"model": entry["model"], "start": time.monotonic(), "first": None}
+            threading.Thread(target=self._attempt, args=(stream, events), daemon=True).start()
+            route.append({"model": entry["model"], "reason": reason, "outcome": "started"})
+
+        def drop(stream, outcome):
+            info = active.pop(stream, None)
+            stream.close()
+            if info is not None:
+                for r in reversed(route):
+                    if r["model"] == info["model"] and r["outcome"] == "started":
+                        r["outcome"] = outcome
+                        break
+            return info
+
+        def stop_all(outcome):
+            for s in list(active):
+                drop(s, outcome)
+
+        launch("primary")
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    stop_all("cancelled")
+                    raise Cancelled()
+                now = time.monotonic()
+                wait = 0.1 if cancel is not None else 1.0
+                if winner is None:
+                    for s, info in list(active.items()):
+                        waited = now - info["start"]
+                        if waited >= self.ttft_deadline:
+                            self._observe(info["model"], False, None, missed_deadline=True)
+                            drop(s, f"no first token after {self.ttft_deadline:g}s")
+                            last_error = UpstreamError(504, "time to first token exceeded", model=info["model"])
+                        elif (self.hedge_after is not None and len(active) == 1 and order
+                              and waited >= self.hedge_after):
+                            launch(f"hedge after {self.hedge_after:g}s")
+                    if not active:
+                        if not order:
+                            raise last_error or UpstreamError(503, "no models available")
+                        launch("fallback")
+                    deadlines = [info["start"] + self.ttft_deadline for info in active.values()]
+                    if self.hedge_after is not None and len(active) == 1 and order:
+                        deadlines += [info["start"] + self.hedge_after for info in active.values()]
+                    wait = min([wait] + [max(0.0, d - now) for d in deadlines])
+                try:
+                    kind, stream, data = events.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if stream not in active:
+                    continue  # late event from an attempt we already dropped
+                info = active[stream]
+                if kind == "first":
+                    info["first"] = data
+                    if winner is None:
+                        winner = stream
+                        self._observe(info["model"], True, data)
+                        for s in list(active):
+                            if s is not winner:
+                                drop(s, "lost the race")
+                elif kind == "delta":
+                    if stream is winner and on_delta is not None:
+                        on_delta(*data)
+                elif kind == "done":
+                    if winner is None:
+                        # finished without any text (empty reply) -- still the answer
+                        self._observe(info["model"], True, data.elapsed)
+                    drop(stream, "won")
+                    stop_all("lost the race")
+                    data.ttft = info["first"]
+                    data.route = route
+                    data.elapsed = time.monotonic() - started
+                    return data
+                elif kind == "error":
+                    if isinstance(data, Cancelled):
+                        continue
+                    if stream is winner:
+                        # mid-stream failure: too late to switch models without duplicating text
+                        drop(stream, f"failed mid-stream: {data}")
+                        raise data
+                    if getattr(data, "status", None) != 429:
+                        self._observe(info["model"], False, None)
+                    drop(stream, f"error: {getattr(data, 'status', type(data).__name__)}")
+                    last_error = data
+        finally:
+            stop_all("abandoned")
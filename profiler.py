@@ -0,0 +1,48 @@
+"""
+Deterministic profile of one script run, for the Debug panel.
+
+    prof = profiler.start()
+    ...                       # the rest of app.py
+    result = profiler.finish(prof)
+
+`result` has the wall time, the top functions by cumulative time and
+`raw`, the same bytes `pstats.Stats.dump_stats` writes, so a downloaded
+file opens with `python -m pstats rerun.prof` or snakeviz.
+
+Only the thread running the script is profiled. Replies are written on
+job threads, so time spent waiting on the network shows up in the
+scheduler/job stats rather than here.
+"""
+import cProfile
+import marshal
+import os
+import pstats
+import time
+
+TOP = 30
+
+
+def start():
+    prof = cProfile.Profile()
+    prof.started = time.perf_counter()
+    prof.enable()
+    return prof
+
+
+def _where(path, line, func):
+    if path == "~":
+        return func  # builtins, e.g. <built-in method builtins.exec>
+    return f"{func} ({os.path.basename(path)}:{line})"
+
+
+def finish(prof, top=TOP):
+    """Stop `prof`; {"total_s", "rows": [{function, calls, own_s, cumulative_s}, ...], "raw": bytes}."""
+    prof.disable()
+    total = time.perf_counter() - prof.started
+    stats = pstats.Stats(prof).stats
+    ranked = sorted(stats.items(), key=lambda kv: kv[1][3], reverse=True)[:top]
+    rows = [
+        {"function": _where(*key), "calls": nc, "own_s": round(tt, 4), "cumulative_s": round(ct, 4)}
+        for key, (_, nc, tt, ct, _) in ranked
+    ]
+    return {"total_s": round(total, 3), "rows": rows, "raw": marshal.dumps(stats)}
@@ -0,0 +1,177 @@
+"""
+Replay a recorded session through the real UI script, offline.
+
+    python replay_ui.py session.jsonl -o report.json
+    python replay_ui.py session.jsonl --latency-scale 0 --baseline report.json
+
+Takes a cassette recorded with RECORD_CASSETTE (see cassette.py). Its
+upstream calls are served by a cassette replay server, and its UI actions
+(say, edit/resend, regenerate, pin, stop, keep partial) are performed on
+app.py through `streamlit.testing` AppTest in a scratch directory. A
+bracket retry or Story continuation replays because the app sends the
+same follow-up request it sent when recording.
+
+For every action it reports wall time until the chat settles, the number
+of script runs it took and the time spent inside them. With --baseline,
+it exits non-zero when total latency or script runs regress by more than
+--tolerance (a fraction).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cassette
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+class Driver:
+    def __init__(self, url, timeout):
+        from streamlit.testing.v1 import AppTest
+
+        self.at = AppTest.from_file(APP, default_timeout=timeout)
+        self.at.secrets["OPENROUTER_API_KEY"] = "replay"
+        self.at.secrets["REFERER_URL"] = "http://localhost"
+        self.at.secrets["OPENROUTER_URL"] = url
+        self.runs = 0
+        self.script_s = 0.0
+
+    def run(self, widget=None):
+        started = time.monotonic()
+        (widget or self.at).run()
+        self.script_s += time.monotonic() - started
+        self.runs += 1
+        if self.at.exception:
+            raise RuntimeError(self.at.exception[0].value)
+
+    def button(self, label=None, key=None):
+        for b in self.at.button:
+            if (label and b.label == label) or (key and (b.key or "").startswith(key)):
+                return b
+        return None
+
+    def busy(self):
+        return self.button(key="stop_") is not None
+
+    def settle(self, timeout):
+        """Poll (as the page's fragment would) until no reply is being written."""
+        deadline = time.monotonic() + timeout
+        while self.busy() and time.monotonic() < deadline:
+            time.sleep(0.1)
+            self.run()
+
+    # ---- actions ----
+    def say(self, action):
+        mode = action.get("mode")
+        if mode and self.at.session_state["mode"] != mode:
+            self.run(self.at.radio(key="mode").set_value(mode))
+        n = action.get("n_candidates")
+        if n and self.at.session_state["n_candidates"] != n:
+            self.run(self.at.slider(key="n_candidates").set_value(n))
+        self.run(self.at.chat_input[0].set_value(action["text"]))
+
+    def edit(self, action):
+        self.run(self.button(key="edit_").click())
+        self.run(self.at.text_area(key=f"edit_{action['index']}").set_value(action["text"]))
+        self.run(self.button(key=f"resend_{action['index']}").click())
+
+    def regenerate(self, action):
+        self.run(self.button("🔄 Regenerate Last Response").click())
+
+    def pin(self, action):
+        self.run(self.button(key=f"pin_{action['index']}").click())
+
+    def stop(self, action):
+        # stopped after roughly as much text as when recorded (if it is still writing)
+        while self.busy():
+            job_text = "".join(m.value for c in self.at.chat_message for m in c.markdown)
+            if len(job_text) >= action.get("chars", 0):
+                self.run(self.button(key="stop_").click())
+                return
+            time.sleep(0.05)
+            self.run()
+
+    def keep_partial(self, action):
+        button = self.button(key="keep_partial")
+        if button is not None:
+            self.run(button.click())
+
+
+def replay(path, latency_scale=1.0, timeout=60.0, loose=True):
+    _, actions = cassette.load(path)
+    server = cassette.serve(path, latency_scale=latency_scale, loose=loose)
+    scratch = tempfile.mkdtemp(prefix="replay-")
+    cwd = os.getcwd()
+    os.chdir(scratch)  # fresh sessions.json / length_stats.json
+    try:
+        d = Driver(server.url, timeout)
+        d.run()
+        steps = []
+        for action in actions:
+            handler = getattr(d, action["action"], None)
+            if handler is None:
+                continue
+            runs, script_s, started = d.runs, d.script_s, time.monotonic()
+            handler(action)
+            d.settle(timeout)
+            steps.append({
+                "action": action["action"],
+                "latency_s": round(time.monotonic() - started, 3),
+                "runs": d.runs - runs,
+                "script_s": round(d.script_s - script_s, 3),
+            })
+        return {
+            "cassette": path,
+            "latency_scale": latency_scale,
+            "steps": steps,
+            "total_latency_s": round(sum(s["latency_s"] for s in steps), 3),
+            "total_runs": sum(s["runs"] for s in steps),
+            "total_script_s": round(sum(s["script_s"] for s in steps), 3),
+            "upstream": {"hits": server.hits, "misses": server.misses, "aborted": server.aborted},
+        }
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def regressions(report, baseline, tolerance):
+    out = []
+    for key in ("total_latency_s", "total_runs", "total_script_s"):
+        if baseline.get(key) and report[key] > baseline[key] * (1 + tolerance):
+            out.append(f"{key}: {report[key]} vs baseline {baseline[key]}")
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("cassette")
+    ap.add_argument("-o", "--output", help="write the report JSON here")
+    ap.add_argument("--latency-scale", type=float, default=1.0)
+    ap.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a reply to finish")
+    ap.add_argument("--strict", action="store_true", help="don't answer unmatched requests with the next recorded call")
+    ap.add_argument("--baseline", help="report JSON to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    args = ap.parse_args(argv)
+
+    report = replay(args.cassette, args.latency_scale, args.timeout, loose=not args.strict)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            problems = regressions(report, json.load(f), args.tolerance)
+        for p in problems:
+            print(f"REGRESSION {p}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Process-wide request scheduler for the shared OpenRouter key.
+
+Every browser session submits its upstream calls here instead of calling
+OpenRouter directly. The scheduler
+
+- keeps token buckets for requests/minute and tokens/minute,
+- runs at most `max_concurrency` calls at once,
+- serves interactive turns before background work (429 retries, prefetch),
+- honors Retry-After: a job that raises `RateLimited` pauses dispatching
+  and is put back in the queue as background work.
+
+Callers get a `Ticket` back and wait on `ticket.future`; `ticket.position()`
+is the 1-based place in the queue (0 once it is running or done).
+"""
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class RateLimited(Exception):
+    """Raise from a job when upstream answered 429; the job is retried later."""
+
+    def __init__(self, retry_after=None, result=None):
+        super().__init__(f"rate limited (retry after {retry_after}s)")
+        self.retry_after = retry_after
+        self.result = result  # handed back to the caller if we give up retrying
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute / 60` per second."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` tokens are available (never more than a full bucket)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+class Ticket:
+    def __init__(self, scheduler, fn, priority, est_tokens, seq):
+        self.scheduler = scheduler
+        self.fn = fn
+        self.priority = priority
+        self.est_tokens = est_tokens
+        self.seq = seq
+        self.attempts = 0
+        self.started = False
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def position(self):
+        return self.scheduler.position(self)
+
+    def cancel(self):
+        """Drop the ticket if it has not started yet."""
+        return self.future.cancel()
+
+
+class RequestScheduler:
+    def __init__(self, rpm=60, tpm=200_000, max_concurrency=4, max_retries=3, max_retry_after=60.0):
+        self.rpm = TokenBucket(rpm)
+        self.tpm = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.cooldown_until = 0.0
+        self.running = 0
+        self.completed = 0
+        self.rate_limited = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._loop, name="openrouter-scheduler", daemon=True).start()
+
+    # ---- public API ----
+    def submit(self, fn, priority=INTERACTIVE, est_tokens=0):
+        ticket = Ticket(self, fn, priority, est_tokens, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._queue, ticket)
+            self._cond.notify()
+        return ticket
+
+    def position(self, ticket):
+        with self._cond:
+            if ticket not in self._queue:
+                return 0
+            return 1 + sum(1 for t in self._queue if t < ticket and not t.future.cancelled())
+
+    def promote(self, ticket, priority=INTERACTIVE):
+        """Move a still-queued ticket up, e.g. a prefetch the user is now waiting on."""
+        with self._cond:
+            if ticket.priority <= priority:
+                return
+            ticket.priority = priority
+            if ticket in self._queue:
+                heapq.heapify(self._queue)
+                self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "running": self.running,
+                "completed": self.completed,
+                "rate_limited": self.rate_limited,
+                "cooldown_s": round(max(0.0, self.cooldown_until - time.monotonic()), 1),
+            }
+
+    # ---- dispatcher ----
+    def _next_delay(self, ticket, now):
+        return max(
+            self.cooldown_until - now,
+            self.rpm.wait_time(1, now),
+            self.tpm.wait_time(ticket.est_tokens, now),
+        )
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._queue or self.running >= self.max_concurrency:
+                    self._cond.wait()
+                ticket = self._queue[0]
+                if ticket.future.cancelled():
+                    heapq.heappop(self._queue)
+                    continue
+                now = time.monotonic()
+                delay = self._next_delay(ticket, now)
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+                if not ticket.started:
+                    if not ticket.future.set_running_or_notify_cancel():
+                        continue
+                    ticket.started = True
+                self.rpm.take(1, now)
+                self.tpm.take(ticket.est_tokens, now)
+                self.running += 1
+            threading.Thread(target=self._run, args=(ticket,), daemon=True).start()
+
+    def _run(self, ticket):
+        requeue = False
+        try:
+            result = ticket.fn()
+        except RateLimited as e:
+            ticket.attempts += 1
+            wait = e.retry_after if e.retry_after is not None else 5.0
+            with self._cond:
+                self.rate_limited += 1
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + min(wait, self.max_retry_after))
+            if ticket.attempts <= self.max_retries and wait <= self.max_retry_after:
+                requeue = True
+            elif e.result is not None:
+                ticket.future.set_result(e.result)
+            else:
+                # surface the upstream error the job translated into RateLimited
+                ticket.future.set_exception(e.__cause__ or e)
+        except BaseException as e:
+            ticket.future.set_exception(e)
+        else:
+            ticket.future.set_result(result)
+        with self._cond:
+            self.running -= 1
+            if requeue:
+                # retries wait behind interactive turns
+                ticket.priority = BACKGROUND
+                heapq.heappush(self._queue, ticket)
+            else:
+                self.completed += 1
+            self._cond.notify()
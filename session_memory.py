@@ -0,0 +1,130 @@
+"""
+Idle-session memory manager.
+
+Every browser tab keeps its own copy of all chats in st.session_state
+(plus the active chat's working copies and debug payloads) for as long
+as Streamlit keeps the session, even when the tab sits idle for hours.
+
+`SessionRegistry` (one per server process) is told about every script
+run with `touch()`. A janitor thread drops the heavy keys of sessions
+idle longer than `idle_after` seconds and leaves an `_evicted_at`
+marker; the app reloads the chats from storage on that session's next
+run. `can_evict(state)` lets the app veto sessions that have unsaved
+work (a reply being written, an edit open).
+"""
+import sys
+import threading
+import time
+
+# what an idle session gives up; all of it can be rebuilt from sessions.json
+HEAVY = ("sessions", "messages", "persona", "canon", "last_debug", "last_profile")
+
+
+def deep_size(obj, seen=None):
+    """Approximate bytes held by `obj` and the containers/strings it references (each object counted once)."""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return total
+
+
+def current():
+    """(session id, session state) of the script run on this thread, or (None, None)."""
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return None, None
+    return ctx.session_id, ctx.session_state
+
+
+def _session_alive(session_id):
+    from streamlit.runtime import Runtime
+
+    if not Runtime.exists():
+        return True  # e.g. AppTest: nothing to ask, keep tracking
+    return Runtime.instance().is_active_session(session_id)
+
+
+class SessionRegistry:
+    def __init__(self, idle_after=900, interval=60, can_evict=None, heavy=HEAVY, is_alive=_session_alive):
+        self.idle_after = idle_after
+        self.interval = interval
+        self.can_evict = can_evict or (lambda state: True)
+        self.heavy = heavy
+        self.is_alive = is_alive
+        self.evictions = 0
+        self.freed_bytes = 0
+        self._entries = {}  # session id -> {"state", "last_active", "evicted"}
+        self._lock = threading.Lock()
+        if interval:
+            threading.Thread(target=self._janitor, name="session-janitor", daemon=True).start()
+
+    def touch(self, session_id, state):
+        """Mark a session as active now (call at the top of every run)."""
+        with self._lock:
+            self._entries[session_id] = {"state": state, "last_active": time.time(), "evicted": False}
+
+    def evict_idle(self, now=None):
+        """Drop the heavy keys of every idle session that allows it; returns how many were evicted."""
+        now = now or time.time()
+        count = 0
+        with self._lock:
+            for sid, entry in list(self._entries.items()):
+                if not self.is_alive(sid):
+                    del self._entries[sid]  # tab closed: Streamlit frees the rest
+                    continue
+                if entry["evicted"] or now - entry["last_active"] < self.idle_after:
+                    continue
+                state = entry["state"]
+                if not self.can_evict(state):
+                    continue
+                seen = set()
+                for key in self.heavy:
+                    if key in state:
+                        self.freed_bytes += deep_size(state[key], seen)
+                        del state[key]
+                state["_evicted_at"] = now
+                entry["evicted"] = True
+                count += 1
+        self.evictions += count
+        return count
+
+    def resident(self, state):
+        """{key: bytes} for the heavy keys `state` currently holds."""
+        seen = set()
+        return {key: deep_size(state[key], seen) for key in self.heavy if key in state}
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            entries = list(self._entries.values())
+        sizes = [sum(self.resident(e["state"]).values()) for e in entries if not e["evicted"]]
+        return {
+            "sessions": len(entries),
+            "idle": sum(now - e["last_active"] >= self.idle_after for e in entries),
+            "evicted": sum(e["evicted"] for e in entries),
+            "evictions": self.evictions,
+            "freed_mb": round(self.freed_bytes / 2**20, 2),
+            "resident_mb": round(sum(sizes) / 2**20, 2),
+            "resident_mb_per_session": round(sum(sizes) / len(sizes) / 2**20, 3) if sizes else 0.0,
+        }
+
+    def _janitor(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.evict_idle()
+            except Exception:
+                pass  # a bad session must not stop the janitor
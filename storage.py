@@ -0,0 +1,254 @@
+"""
+Chat persistence (sessions.json), shared by the UI and background jobs.
+
+Every write goes through one process-wide lock and an atomic replace, so
+a job saving its reply and a browser session saving its chats never
+interleave half-written files.
+
+Chats not opened for a while are moved to a cold tier: one compressed
+file per chat in `<save path stem>.archive/` (zstd if `zstandard` is
+installed, else gzip; msgpack inside if `msgpack` is, else JSON). The
+hot index then keeps only a stub under the chat's name:
+
+    {"id": ..., "archived": "<file>", "last_opened": ..., "messages": 42}
+
+`rehydrate` swaps the full record back in when the chat is opened.
+"""
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import history
+
+_LOCK = threading.RLock()
+
+
+def empty_persona():
+    return {"who": "", "role": "", "themes": "", "boundaries": ""}
+
+
+def new_record(base_msg):
+    """A fresh chat holding only the base system message."""
+    return {
+        "id": uuid.uuid4().hex,
+        "tree": history.new_tree([base_msg]),
+        "persona": empty_persona(),
+        "canon": [],
+        "last_opened": time.time(),
+    }
+
+
+def normalize(sessions, base_msg):
+    """MIGRATION: bring every stored chat up to the current record format."""
+    migrated = {}
+    for name, val in sessions.items():
+        if isinstance(val, list):
+            # oldest format: the chat was just its message list
+            val = {"messages": val}
+        if is_archived(val):
+            migrated[name] = val
+            continue
+        migrated[name] = {
+            "id": val.get("id") or uuid.uuid4().hex,
+            "tree": val.get("tree") or history.new_tree(val.get("messages", [base_msg])),
+            "persona": val.get("persona", empty_persona()),
+            "canon": val.get("canon", []),
+            # chats from before cold storage count as opened now, so they aren't all archived at once
+            "last_opened": val.get("last_opened") or time.time(),
+        }
+    return migrated
+
+
+def load_sessions(path, base_msg):
+    """All chats from `path` (normalized), or {} if there is no file yet."""
+    with _LOCK:
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as f:
+            return normalize(json.load(f), base_msg)
+
+
+def save_sessions(path, sessions):
+    """
+    Write `sessions` to `path`. An archived stub never replaces a full record
+    with the same id that was opened since (another tab unpacked the chat
+    meanwhile): that record is kept, and `sessions` picks it up.
+    """
+    with _LOCK:
+        if os.path.exists(path) and any(is_archived(r) for r in sessions.values()):
+            with open(path, "r") as f:
+                on_disk = json.load(f)
+            newer = {r["id"]: r for r in on_disk.values()
+                     if isinstance(r, dict) and r.get("id") and "tree" in r and not is_archived(r)}
+            for name, rec in sessions.items():
+                full = newer.get(rec.get("id")) if is_archived(rec) else None
+                if full is not None and full.get("last_opened", 0) > rec.get("last_opened", 0):
+                    sessions[name] = full
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(sessions, f)
+        os.replace(tmp, path)
+
+
+def append_message(path, chat_id, branch, msg):
+    """
+    Append one message to a chat branch on disk, looked up by chat id so a
+    rename in the meantime doesn't matter. Returns False if the chat or
+    branch is gone.
+    """
+    with _LOCK:
+        if not os.path.exists(path):
+            return False
+        with open(path, "r") as f:
+            sessions = json.load(f)
+        for rec in sessions.values():
+            if isinstance(rec, dict) and rec.get("id") == chat_id:
+                if is_archived(rec):
+                    full = _read_archive(path, rec)
+                    if full is None or branch not in full["tree"]["branches"]:
+                        return False
+                    history.append(full["tree"], branch, msg)
+                    _write_archive(path, full)
+                    rec["messages"] = rec.get("messages", 0) + 1
+                    save_sessions(path, sessions)
+                    return True
+                tree = rec.get("tree")
+                if not tree or branch not in tree["branches"]:
+                    return False
+                history.append(tree, branch, msg)
+                save_sessions(path, sessions)
+                return True
+        return False
+
+
+# ---------------- Cold storage ----------------
+def is_archived(rec):
+    return isinstance(rec, dict) and "archived" in rec
+
+
+def archive_dir(path):
+    return f"{os.path.splitext(path)[0]}.archive"
+
+
+def _encode(rec):
+    """(bytes, file suffix) for one full chat record."""
+    if msgpack is not None:
+        raw, fmt = msgpack.packb(rec, use_bin_type=True), "msgpack"
+    else:
+        raw, fmt = json.dumps(rec, separators=(",", ":")).encode(), "json"
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(raw), f".{fmt}.zst"
+    return gzip.compress(raw, compresslevel=6), f".{fmt}.gz"
+
+
+def _decode(data, filename):
+    if filename.endswith(".zst"):
+        if zstandard is None:
+            raise RuntimeError(f"{filename} needs the zstandard package")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raw = gzip.decompress(data)
+    if ".msgpack." in filename:
+        if msgpack is None:
+            raise RuntimeError(f"{filename} needs the msgpack package")
+        return msgpack.unpackb(raw, raw=False)
+    return json.loads(raw)
+
+
+def _write_archive(path, rec):
+    """Write one full record to the cold tier; returns (file name, compressed size)."""
+    data, suffix = _encode(rec)
+    folder = archive_dir(path)
+    os.makedirs(folder, exist_ok=True)
+    filename = f"{rec['id']}{suffix}"
+    tmp = os.path.join(folder, f"{filename}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, os.path.join(folder, filename))
+    return filename, len(data)
+
+
+def _read_archive(path, stub):
+    """The full record behind a stub, or None if its file is gone."""
+    try:
+        with open(os.path.join(archive_dir(path), stub["archived"]), "rb") as f:
+            return _decode(f.read(), stub["archived"])
+    except FileNotFoundError:
+        return None
+
+
+def archive_stale(path, sessions, max_age_s, keep=()):
+    """
+    Move chats not opened for `max_age_s` seconds (except those named in
+    `keep`) to the cold tier, replacing them in `sessions` with stubs.
+    Returns the names archived; the index is saved if there were any.
+    """
+    cutoff = time.time() - max_age_s
+    archived = []
+    with _LOCK:
+        for name, rec in sessions.items():
+            if name in keep or is_archived(rec) or rec.get("last_opened", 0) > cutoff:
+                continue
+            filename, size = _write_archive(path, rec)
+            sessions[name] = {
+                "id": rec["id"],
+                "archived": filename,
+                "last_opened": rec.get("last_opened", 0),
+                "messages": sum(len(b["delta"]) for b in rec["tree"]["branches"].values()),
+                "bytes": size,
+            }
+            archived.append(name)
+        if archived:
+            save_sessions(path, sessions)
+    return archived
+
+
+def rehydrate(path, sessions, name):
+    """
+    The full record for chat `name`, brought back from the cold tier if it
+    was archived, and marked as opened now. `sessions` is updated in place
+    and saved; the archive file is only removed once the saved index no
+    longer refers to it. Raises FileNotFoundError if the archive is gone
+    and no full copy is on disk either.
+    """
+    rec = sessions[name]
+    if not is_archived(rec):
+        rec["last_opened"] = time.time()
+        return rec
+    with _LOCK:
+        full = _read_archive(path, rec)
+        if full is None:
+            # another session brought it back already: take the full record from the index on disk
+            on_disk = load_sessions(path, None)
+            full = next((r for r in on_disk.values() if r.get("id") == rec["id"] and not is_archived(r)), None)
+        if full is None:
+            raise FileNotFoundError(f"archive for chat {name!r} is missing")
+        full["last_opened"] = time.time()
+        sessions[name] = full
+        save_sessions(path, sessions)
+        # the file on disk now equals `sessions`; a stub still held by another tab
+        # gets the full record from it on that tab's next save or rehydrate
+        if not any(is_archived(r) and r["archived"] == rec["archived"] for r in sessions.values()):
+            remove_archive(path, rec)
+    return full
+
+
+def remove_archive(path, rec):
+    """Delete the cold-tier file behind a stub (no-op for a full record)."""
+    if is_archived(rec):
+        try:
+            os.remove(os.path.join(archive_dir(path), rec["archived"]))
+        except FileNotFoundError:
+            pass